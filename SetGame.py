@@ -1,23 +1,124 @@
 #!/usr/bin/env python
 """SetGame class and some helper classes."""
 
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from random import randint, shuffle
 from itertools import permutations, combinations
 import cv2
 import numpy as np
-from tqdm import tqdm
+import instrument
 from common import (
+    CARD_ATTRS,
     SOLVE_OUT,
     clean_make_dir,
     display_im,
     write_im,
+    load_im,
     label_to_dict,
     scale_points,
 )
-from classify_card import classify_card_from_im
+from classify_card import (
+    DEFAULT_ENGINE,
+    HEADLESS_ENGINE,
+    classify_card_from_im,
+    classify_card_with_confidence,
+)
 from card_finder import find_cards
 
 
+class CardEncoding(object):
+    """Encodes card labels as small integers. Each attribute (in sorted order,
+  the same order as in labels) is a digit holding the index of its value, in
+  base num_values. Every attribute must have the same number of values, which
+  is also the number of cards in a set.
+  """
+
+    def __init__(self, card_attrs=CARD_ATTRS):
+        self.attrs = sorted(card_attrs.keys())
+        num_values = set(len(card_attrs[attr]) for attr in self.attrs)
+        if len(num_values) != 1:
+            raise ValueError("All card attributes must have the same number of values")
+        self.num_values = num_values.pop()
+        self.value_idxs = [
+            {value: i for i, value in enumerate(card_attrs[attr])}
+            for attr in self.attrs
+        ]
+
+    def encode(self, label):
+        """Convert a label like 'red-triple-stripes-squiggle.jpg' to its code."""
+        tokens = [t.split(".")[0] for t in label.split("-")]
+        if len(tokens) != len(self.attrs):
+            raise ValueError("Cannot encode card label {}".format(label))
+        return self.from_digits(
+            [value_idxs[token] for value_idxs, token in zip(self.value_idxs, tokens)]
+        )
+
+    def from_digits(self, digits):
+        code = 0
+        for digit in reversed(digits):
+            code = code * self.num_values + digit
+        return code
+
+    def digits(self, code):
+        ret = []
+        for _ in self.attrs:
+            code, digit = divmod(code, self.num_values)
+            ret.append(digit)
+        return tuple(ret)
+
+    def complete_set(self, digits_list):
+        """Given the digits of all but one card of a potential set, return the
+    code of the only card that completes it, or None if there is none. For
+    each attribute the cards are either all the same or all different, so
+    the missing value is fully determined.
+    """
+        all_values = set(range(self.num_values))
+        digits = []
+        for values in zip(*digits_list):
+            distinct = set(values)
+            if len(distinct) == 1:
+                digits.append(values[0])
+            elif len(distinct) == len(values):
+                missing = all_values - distinct
+                if len(missing) != 1:
+                    return None
+                digits.append(missing.pop())
+            else:
+                return None
+        return self.from_digits(digits)
+
+    def is_set(self, codes):
+        for values in zip(*[self.digits(code) for code in codes]):
+            if len(set(values)) not in (1, self.num_values):
+                return False
+        return True
+
+    def find_sets(self, codes):
+        """Return index tuples of every set among the card codes, in the same
+    order itertools.combinations would produce them. Every group of all but
+    one card determines the last one, which is looked up in an index, so a
+    standard game costs O(n^2) instead of O(n^3).
+    """
+        digits = [self.digits(code) for code in codes]
+        # code -> ascending positions of the cards with that code
+        positions = {}
+        for i, code in enumerate(codes):
+            positions.setdefault(code, []).append(i)
+
+        sets = []
+        for idxs in combinations(range(len(codes)), self.num_values - 1):
+            last = self.complete_set([digits[i] for i in idxs])
+            for i in positions.get(last, ()):
+                if i > idxs[-1]:
+                    sets.append(idxs + (i,))
+        return sets
+
+
+# encoding of the standard deck
+ENCODING = CardEncoding()
+
+
 class Cv2Image(object):
     def display(self):
         display_im(self.im)
@@ -29,10 +130,28 @@ class Card(Cv2Image):
         # list of (x,y) tuples mapping to the corners of the card in original im
         self.corners = corners
         self.label = None
+        # {attr: 0-1}, only known for cards classified headless
+        self.confidence = None
+        # whether the label can be trusted to find sets with
+        self.confident = True
 
     def __repr__(self):
         return "<Card {}>".format(self.label)
 
+    def classified(self, classification):
+        """Take the label and confidence of a CardClassification."""
+        self.label = classification.label
+        self.confidence = classification.confidence
+        self.confident = classification.confident
+
+    def to_dict(self):
+        """JSON serializable label, corners and, if known, confidence."""
+        ret = {"label": self.label, "corners": self.corners.tolist()}
+        if self.confidence is not None:
+            ret["confidence"] = {k: round(v, 3) for k, v in self.confidence.items()}
+            ret["confident"] = self.confident
+        return ret
+
     @property
     def attrs(self):
         if self.label:
@@ -40,33 +159,103 @@ class Card(Cv2Image):
 
 
 class SetGame(Cv2Image):
-    def __init__(self, filename):
-        self.filename = filename
-        self.im = cv2.imread(filename, 1)
+    def __init__(self, src, card_attrs=CARD_ATTRS, cache=None):
+        """src is a filename, encoded image bytes, or a decoded BGR image. It is
+    decoded once, and that one image is used from card detection through
+    drawing the sets (which draws onto it). If a card_cache.CardCache is
+    given, cards that look like ones it has seen reuse their labels.
+    """
+        self.cache = cache
+        self.filename = src if isinstance(src, str) else None
+        self.im = load_im(src)
+        self.encoding = (
+            ENCODING if card_attrs is CARD_ATTRS else CardEncoding(card_attrs)
+        )
         self.cards = []
         # list of Card 3-tuples
         self.sets = []
 
-    def get_cards(self, show_tqdm=True):
-        """Find and classify cards from game image."""
-        card_ims_with_corners = find_cards(self.filename, with_corners=True)
+    def classify_headless(self, card_im, review_queue=None, engine=HEADLESS_ENGINE):
+        """Classify a card without ever asking for help, returning a
+    CardClassification. Only labels that were confident when they were cached
+    are reused, and only confident labels are cached. Cards that aren't
+    confident are added to review_queue, if given.
+    """
+        if self.cache is not None:
+            cached = self.cache.get(card_im, engine)
+            if cached is not None and cached.confident:
+                return cached
+        classification = classify_card_with_confidence(card_im, engine=engine)
+        if classification.confident:
+            if self.cache is not None:
+                self.cache.put(card_im, classification, engine)
+        elif review_queue is not None:
+            review_queue.add(card_im, classification, source=self.filename)
+        return classification
+
+    def get_cards(
+        self, show_tqdm=True, workers=1, headless=False, review_queue=None, engine=None
+    ):
+        """Find and classify cards from game image. With workers > 1, cards are
+    classified concurrently by a pool of that many threads (most of the work
+    is in OpenCV, which releases the GIL). Cards keep the order find_cards
+    returned them in either way.
+
+    If headless is set, cards are never labeled by hand: each gets the best
+    guess label and confidence, and the ones that aren't confident are left
+    out of the sets and added to review_queue, if given.
+
+    engine is the classifier engine, by default HEADLESS_ENGINE if headless
+    is set and DEFAULT_ENGINE otherwise.
+    """
+        card_ims_with_corners = find_cards(self.im, with_corners=True)
         for im, corner in card_ims_with_corners:
             self.cards.append(Card(im, corner))
-        card_iter = tqdm(self.cards) if show_tqdm else self.cards
-        for card in card_iter:
-            card.label = classify_card_from_im(card.im)
+
+        if engine is None:
+            engine = HEADLESS_ENGINE if headless else DEFAULT_ENGINE
+        if headless:
+            classify = functools.partial(
+                self.classify_headless, review_queue=review_queue, engine=engine
+            )
+        elif self.cache is None:
+            classify = functools.partial(classify_card_from_im, engine=engine)
+        else:
+            classify = functools.partial(self.cache.classify, engine=engine)
+        if show_tqdm:
+            from tqdm import tqdm
+
+        card_ims = [card.im for card in self.cards]
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                labels = executor.map(classify, card_ims)
+                if show_tqdm:
+                    labels = tqdm(labels, total=len(card_ims))
+                labels = list(labels)
+        else:
+            card_iter = tqdm(card_ims) if show_tqdm else card_ims
+            labels = [classify(im) for im in card_iter]
+
+        for card, label in zip(self.cards, labels):
+            if headless:
+                card.classified(label)
+            else:
+                card.label = label
 
     @staticmethod
-    def is_set(cards):
-        for attr in cards[0].attrs.keys():
-            if len(set([card.attrs[attr] for card in cards])) == 2:
-                return False
-        return True
+    def is_set(cards, encoding=ENCODING):
+        return encoding.is_set([encoding.encode(card.label) for card in cards])
 
     def find_sets(self):
-        """Try all combinations of 3 cards to find sets."""
-        combos = combinations(self.cards, 3)
-        self.sets = [c for c in combos if self.is_set(c)]
+        """Find every set among the confidently classified cards. Labels are
+    encoded once, then sets are found by looking up the card that completes
+    each pair.
+    """
+        cards = [card for card in self.cards if card.label and card.confident]
+        codes = [self.encoding.encode(card.label) for card in cards]
+        self.sets = [
+            tuple(cards[i] for i in idxs) for idxs in self.encoding.find_sets(codes)
+        ]
         return self.sets
 
     def print_sets(self):
@@ -108,8 +297,9 @@ class SetGame(Cv2Image):
                 corners = scale_points(np.copy(card.corners), (xscale, yscale))
 
                 for pt in range(-1, len(card.corners) - 1):
-                    p1 = (corners[pt][0], corners[pt][1])
-                    p2 = (corners[pt + 1][0], corners[pt + 1][1])
+                    # cv2.line only takes integer coordinates
+                    p1 = (int(corners[pt][0]), int(corners[pt][1]))
+                    p2 = (int(corners[pt + 1][0]), int(corners[pt + 1][1]))
                     cv2.line(self.im, p1, p2, color, line_thickness)
 
     def write_im(self, filename, out_dir=SOLVE_OUT):
@@ -117,7 +307,17 @@ class SetGame(Cv2Image):
             clean_make_dir(out_dir)
         return write_im(self.im, filename, out_dir=out_dir)
 
-    def solve(self):
-        """Run through entire pipeline to get and save sets."""
-        self.get_cards()
-        self.find_sets()
+    def solve(self, workers=1, headless=False, review_queue=None, engine=None):
+        """Run through entire pipeline to get and save sets. See get_cards for
+    headless, review_queue and engine.
+    """
+        with instrument.span("SetGame.solve"):
+            with instrument.span("SetGame.get_cards"):
+                self.get_cards(
+                    workers=workers,
+                    headless=headless,
+                    review_queue=review_queue,
+                    engine=engine,
+                )
+            with instrument.span("SetGame.find_sets"):
+                self.find_sets()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Classify a card's number, shade and shape from the geometry of its shape
+contours, without matching against templates.
+
+The thresholds below were calibrated on image-data/all-cards/labeled and
+image-data/set-game-cards, and sit in the middle of the gaps between the
+ranges measured for each class.
+"""
+
+import sys
+import cv2
+import numpy as np
+from card_features import CardFeatures
+
+# contours smaller than this fraction of the card are specks, not shapes
+MIN_SHAPE_AREA = 0.02
+# ...and a shape must be at least this fraction of the largest one's area
+MIN_SHAPE_AREA_RATIO = 0.5
+
+# contour area / min area rectangle area, measured diamond 0.59-0.61,
+# squiggle 0.75-0.77, capsule 0.86-0.90
+DIAMOND_MAX_EXTENT = 0.68
+# contour area / convex hull area, measured squiggle 0.85-0.86,
+# capsule and diamond 0.96-0.99
+SQUIGGLE_MAX_SOLIDITY = 0.92
+
+# inset of the shape's interior from its outline, as a fraction of its
+# width, so the outline itself doesn't count as fill
+INTERIOR_INSET = 0.08
+# fraction of the interior that is ink, measured solid 1.0, stripes up to 0.49
+SOLID_MIN_FILL = 0.75
+# fraction cut off each end of the line the stripe contrast is measured on
+PROFILE_TRIM = 0.15
+# gray level range along the shape's long axis, relative to the contrast
+# between ink and card, measured outline up to 0.06, stripes from 0.26
+STRIPES_MIN_CONTRAST = 0.15
+
+
+class ShapeStats(object):
+    """Measurements of one shape contour on a card."""
+
+    def __init__(self, contour, gray, thresh):
+        area = cv2.contourArea(contour)
+        (_, _), (w, h), _ = cv2.minAreaRect(contour)
+        hull_area = cv2.contourArea(cv2.convexHull(contour))
+        self.extent = area / (w * h or 1)
+        self.solidity = area / (hull_area or 1)
+
+        # everything else only looks at the shape's bounding box
+        x, y, bw, bh = cv2.boundingRect(contour)
+        gray = gray[y : y + bh, x : x + bw]
+        thresh = thresh[y : y + bh, x : x + bw]
+        mask = np.zeros(gray.shape, np.uint8)
+        cv2.drawContours(mask, [contour], -1, 255, -1, offset=(-x, -y))
+
+        inset = max(1, int(INTERIOR_INSET * min(w, h)))
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * inset + 1,) * 2)
+        interior = cv2.erode(mask, kernel)
+        interior_area = cv2.countNonZero(interior)
+        if interior_area:
+            ink = cv2.countNonZero(cv2.bitwise_and(thresh, interior))
+            self.fill = float(ink) / interior_area
+        else:
+            self.fill = 0.0
+
+        # stripes run across the shape, so a line along its long axis through
+        # the middle crosses all of them
+        if bh >= bw:
+            profile, on = gray[:, bw // 2], interior[:, bw // 2]
+        else:
+            profile, on = gray[bh // 2, :], interior[bh // 2, :]
+        profile = profile[on > 0]
+        # the ends of the line run close to the outline
+        trim = int(len(profile) * PROFILE_TRIM)
+        profile = np.sort(profile[trim : len(profile) - trim])
+        if len(profile):
+            card_level = cv2.mean(gray, mask=cv2.bitwise_not(mask))[0]
+            ink_level = cv2.minMaxLoc(gray, mask=thresh)[0]
+            contrast = max(card_level - ink_level, 1.0)
+            # 10th to 90th percentile, so single noisy pixels don't count
+            n = len(profile)
+            spread = float(profile[n * 9 // 10]) - float(profile[n // 10])
+            self.stripe_contrast = spread / contrast
+        else:
+            self.stripe_contrast = 0.0
+
+
+def card_shape_stats(card):
+    """ShapeStats of each shape on the card (or its CardFeatures), largest
+  first, ignoring specks.
+  """
+    features = CardFeatures.of(card)
+    contours = features.contours
+    if not contours:
+        return []
+    card_area = features.gray.shape[0] * features.gray.shape[1]
+    largest = cv2.contourArea(contours[0])
+    min_area = max(MIN_SHAPE_AREA * card_area, MIN_SHAPE_AREA_RATIO * largest)
+    shapes = [c for c in contours[:3] if cv2.contourArea(c) >= min_area]
+    return [ShapeStats(c, features.gray, features.thresh) for c in shapes]
+
+
+def classify_number(stats):
+    return ["", "single", "double", "triple"][len(stats)]
+
+
+def classify_shade(stats):
+    if not stats:
+        return ""
+    fill = np.mean([s.fill for s in stats])
+    if fill >= SOLID_MIN_FILL:
+        return "solid"
+    contrast = np.mean([s.stripe_contrast for s in stats])
+    return "stripes" if contrast >= STRIPES_MIN_CONTRAST else "outline"
+
+
+def classify_shape(stats):
+    if not stats:
+        return ""
+    if np.mean([s.extent for s in stats]) < DIAMOND_MAX_EXTENT:
+        return "diamond"
+    if np.mean([s.solidity for s in stats]) < SQUIGGLE_MAX_SOLIDITY:
+        return "squiggle"
+    return "capsule"
+
+
+def threshold_margin(value, threshold):
+    """How far value is from threshold, as a fraction of threshold."""
+    return abs(value - threshold) / threshold
+
+
+def number_margin(card, number):
+    """How clearly the card (or its CardFeatures) has number shapes: the
+  smaller of the smallest counted contour's area and the gap to the
+  largest uncounted one, both relative to the largest shape's area.
+  """
+    contours = CardFeatures.of(card).contours
+    if not number or not contours:
+        return 0.0
+    areas = [cv2.contourArea(c) for c in contours]
+    largest = areas[0] or 1.0
+    next_area = areas[number] if len(areas) > number else 0.0
+    return min(areas[number - 1], largest - next_area) / largest
+
+
+def shade_margin(stats):
+    """How far the measurements classify_shade decided on are from its
+  thresholds, see threshold_margin.
+  """
+    if not stats:
+        return 0.0
+    fill = np.mean([s.fill for s in stats])
+    margin = threshold_margin(fill, SOLID_MIN_FILL)
+    if fill >= SOLID_MIN_FILL:
+        return margin
+    contrast = np.mean([s.stripe_contrast for s in stats])
+    return min(margin, threshold_margin(contrast, STRIPES_MIN_CONTRAST))
+
+
+def shape_margin(stats):
+    """How far the measurements classify_shape decided on are from its
+  thresholds, see threshold_margin.
+  """
+    if not stats:
+        return 0.0
+    extent = np.mean([s.extent for s in stats])
+    margin = threshold_margin(extent, DIAMOND_MAX_EXTENT)
+    if extent < DIAMOND_MAX_EXTENT:
+        return margin
+    solidity = np.mean([s.solidity for s in stats])
+    return min(margin, threshold_margin(solidity, SQUIGGLE_MAX_SOLIDITY))
+
+
+def classify_number_shade_shape(card):
+    """(number, shade, shape) of a card image or its CardFeatures, with empty
+  strings if no shapes were found.
+  """
+    stats = card_shape_stats(card)
+    return classify_number(stats), classify_shade(stats), classify_shape(stats)
+
+
+def main():
+    for card_file in sys.argv[1:]:
+        print(card_file, *classify_number_shade_shape(cv2.imread(card_file)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""Solve SET from asyncio code without blocking the event loop.
+
+Decoding, card detection and each card's classification run on an
+executor (the loop's default thread pool unless one is given), and every
+stage in between is a point where the solve can be cancelled. Cards that
+haven't started classifying when a solve is cancelled are never classified.
+Classification is headless, so nothing waits on a card being labeled by
+hand: sets are found among the confident cards, and the others go to the
+solver's review queue, if it has one.
+
+    solver = AsyncSolver(max_concurrent=4)
+    result = await solver.solve_image("setgame7.jpg")
+
+    async for event in solver.stream_image(encoded_bytes):
+        ...  # one {"type": "card"} event per card as it is recognized,
+             # then {"type": "sets"}
+
+usage: ./async_solve.py image-data/set-games/*.jpg
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from card_finder import find_cards
+from classify_card import ENGINES, HEADLESS_ENGINE, classify_card_with_confidence
+from common import load_im
+from review_queue import ReviewQueue
+from SetGame import ENCODING
+
+# images solved at once, others wait their turn
+DEFAULT_MAX_CONCURRENT = 4
+
+# fields of a card event that solve_image returns for each card
+CARD_KEYS = ("label", "confidence", "confident", "corners")
+
+
+def decode(src):
+    """load_im, raising IOError if src cannot be read."""
+    im = load_im(src)
+    if im is None:
+        name = src if isinstance(src, str) else "from bytes"
+        raise IOError("Cannot read image {}".format(name))
+    return im
+
+
+def find_card_ims(im):
+    """(card image, corners) of every card in im, all at once."""
+    return list(find_cards(im, with_corners=True))
+
+
+class AsyncSolver(object):
+    """Solves images with the blocking work done on executor, at most
+  max_concurrent images at a time. A ProcessPoolExecutor works too, as
+  everything sent to it can be pickled. Cards that aren't classified
+  confidently are added to review_queue, if given.
+  """
+
+    def __init__(
+        self,
+        executor=None,
+        max_concurrent=DEFAULT_MAX_CONCURRENT,
+        engine=HEADLESS_ENGINE,
+        review_queue=None,
+    ):
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine {}".format(engine))
+        self.executor = executor
+        self.max_concurrent = max_concurrent
+        self.engine = engine
+        self.review_queue = review_queue
+        # created in the running loop, again if the solver is used from
+        # another one
+        self._semaphore = None
+        self._loop = None
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def _classify(self, i, card_im, source):
+        classify = functools.partial(classify_card_with_confidence, engine=self.engine)
+        classification = await self._run(classify, card_im)
+        if not classification.confident and self.review_queue is not None:
+            await self._run(self.review_queue.add, card_im, classification, source)
+        return i, classification
+
+    async def stream_image(self, src):
+        """Solve src (a filename, encoded image bytes or a decoded image),
+    yielding a {"type": "card"} event with its index, label, confidence and
+    corners as each card is classified, in the order they finish, then one
+    {"type": "sets"} event with the sets (as card indexes) and timing.
+    """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            self._loop = loop
+
+        async with self._semaphore:
+            timing = {}
+            start = time.time()
+            im = await self._run(decode, src)
+            timing["decode"] = time.time() - start
+
+            stage_start = time.time()
+            cards = await self._run(find_card_ims, im)
+            timing["find_cards"] = time.time() - stage_start
+
+            stage_start = time.time()
+            source = src if isinstance(src, str) else None
+            tasks = [
+                asyncio.ensure_future(self._classify(i, card_im, source))
+                for i, (card_im, _) in enumerate(cards)
+            ]
+            results = [None] * len(cards)
+            try:
+                for done in asyncio.as_completed(tasks):
+                    i, result = await done
+                    results[i] = result
+                    yield {
+                        "type": "card",
+                        "index": i,
+                        "label": result.label,
+                        "confidence": result.to_dict()["confidence"],
+                        "confident": result.confident,
+                        "corners": cards[i][1].tolist(),
+                    }
+            finally:
+                # cancelled, or the caller stopped listening: drop the cards
+                # that haven't started classifying
+                for task in tasks:
+                    task.cancel()
+            timing["classify"] = time.time() - stage_start
+
+            # sets only among the confident cards, as indexes into all of them
+            confident = [i for i, result in enumerate(results) if result.confident]
+            codes = [ENCODING.encode(results[i].label) for i in confident]
+            sets = [[confident[i] for i in s] for s in ENCODING.find_sets(codes)]
+            timing["total"] = time.time() - start
+        # after the slot is given back, in case the caller stops listening
+        # once it has the sets
+        yield {"type": "sets", "sets": sets, "timing": timing}
+
+    async def solve_image(self, src):
+        """Solve src, returning its cards (label, confidence and corners, in
+    the order they were found), sets (as indexes into cards) and timing.
+    """
+        cards = []
+        async for event in self.stream_image(src):
+            if event["type"] == "card":
+                cards.append(event)
+            else:
+                result = event
+        cards.sort(key=lambda card: card["index"])
+        return {
+            "cards": [{key: card[key] for key in CARD_KEYS} for card in cards],
+            "sets": result["sets"],
+            "timing": result["timing"],
+        }
+
+
+async def solve_image(src, solver=None):
+    """AsyncSolver.solve_image, with a default solver if none is given."""
+    return await (solver or AsyncSolver()).solve_image(src)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Solve game images concurrently, printing each card as it "
+        "is recognized as a JSON line."
+    )
+    parser.add_argument("filenames", metavar="filename", type=str, nargs="+")
+    parser.add_argument(
+        "--max-concurrent",
+        dest="max_concurrent",
+        type=int,
+        default=DEFAULT_MAX_CONCURRENT,
+        help="Images solved at once (default %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=None,
+        help="Size of the executor (default: Python's thread pool default)",
+    )
+    parser.add_argument(
+        "--processes",
+        dest="processes",
+        action="store_true",
+        help="Use worker processes instead of threads",
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        default=HEADLESS_ENGINE,
+        help="Classifier engine for number, shade and shape (default %(default)s)",
+    )
+    parser.add_argument(
+        "--review-queue",
+        dest="review_queue",
+        type=str,
+        help="Save the cards that weren't classified confidently to this "
+        "directory, to label with review_queue.py",
+    )
+    return parser.parse_args()
+
+
+async def print_events(solver, filename):
+    try:
+        async for event in solver.stream_image(filename):
+            event["filename"] = filename
+            print(json.dumps(event))
+    except IOError as e:
+        print(json.dumps({"type": "error", "filename": filename, "error": str(e)}))
+
+
+async def solve_all(solver, filenames):
+    await asyncio.gather(*[print_events(solver, f) for f in filenames])
+
+
+def main():
+    args = get_args()
+    pool = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    with pool(args.workers) as executor:
+        review_queue = ReviewQueue(args.review_queue) if args.review_queue else None
+        solver = AsyncSolver(executor, args.max_concurrent, args.engine, review_queue)
+        asyncio.run(solve_all(solver, args.filenames))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,23 +10,21 @@ purple (89, 0, 76)
 
 """
 
-import os
-from classify_card import shape_rgb, pixels_mean
-from common import ALL_CARDS_LABELED_DIR, mean
+from classify_card import shape_rgb
+from common import mean
+from dataset_pack import get_pack
 
 
 def main():
-    all_files = os.listdir(ALL_CARDS_LABELED_DIR)
+    # decoded once, then read straight from the packed dataset
+    pack = get_pack("labeled-cards")
 
     res = []
     for color in ("red", "green", "purple"):
-        color_files = [
-            f for f in all_files if f.startswith(color) and f.endswith(".jpg")
-        ]
         color_values = [
-            shape_rgb(os.path.join(ALL_CARDS_LABELED_DIR, f)) for f in color_files
+            shape_rgb(im) for path, im in pack.items() if path.startswith(color)
         ]
-        res.append((color, pixels_mean(color_values)))
+        res.append((color, tuple(mean([c[i] for c in color_values]) for i in range(3))))
     for color, rgb in res:
         print(color, rgb)
 
@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+"""Time each stage of the pipeline over the sample game images and labeled
+card crops, and optionally save the results as a baseline or compare them
+against one to flag regressions.
+
+usage: ./benchmark.py --save baseline.json
+       ./benchmark.py --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+import cv2
+import numpy as np
+from analytic_classifier import classify_number_shade_shape
+from card_finder import DETECT_MAX_DIM, find_cards
+from classify_card import (
+    CASCADE_MARGIN,
+    classify_color,
+    get_best_orb_matches,
+    get_template_bank,
+)
+from common import (
+    CARD_HEIGHT,
+    CARD_WIDTH,
+    SET_GAMES_DIR,
+    SET_GAME_CARDS_DIR,
+    jpgs_in_dir,
+    load_im,
+    mean,
+    median,
+    warp_quad,
+    warp_quads,
+)
+from dataset_pack import get_pack
+from extract_shapes import extract_shapes_from_im
+from SetGame import ENCODING
+
+# how much slower (as a fraction) a stage's median can get before it is
+# flagged as a regression
+DEFAULT_TOLERANCE = 0.2
+
+# commands started in a fresh interpreter by the startup stage
+STARTUP_COMMANDS = [
+    ["solve_set.py", "--help"],
+    ["-c", "import SetGame"],
+]
+
+
+class BenchData(object):
+    """Inputs shared by the stages, loaded once and never timed."""
+
+    def __init__(self, games_dir=SET_GAMES_DIR, cards_dir=SET_GAME_CARDS_DIR):
+        self.game_files = [
+            os.path.join(games_dir, f) for f in sorted(jpgs_in_dir(games_dir))
+        ]
+        self.card_files = []
+        # labels of the cards of each game, for set finding
+        self.game_labels = []
+        for game_dir in sorted(os.listdir(cards_dir)):
+            game_dir = os.path.join(cards_dir, game_dir)
+            labels = sorted(jpgs_in_dir(game_dir))
+            self.card_files.extend([os.path.join(game_dir, f) for f in labels])
+            self.game_labels.append(labels)
+        self._game_ims = None
+        self._card_ims = None
+        self._game_quads = None
+
+    @property
+    def game_ims(self):
+        if self._game_ims is None:
+            self._game_ims = [load_im(f) for f in self.game_files]
+        return self._game_ims
+
+    @property
+    def game_quads(self):
+        """Corners of the cards found in each game image."""
+        if self._game_quads is None:
+            self._game_quads = [
+                [c for _, c in find_cards(im, with_corners=True)]
+                for im in self.game_ims
+            ]
+        return self._game_quads
+
+    @property
+    def card_ims(self):
+        if self._card_ims is None:
+            self._card_ims = [load_im(f) for f in self.card_files]
+        return self._card_ims
+
+
+def bench_startup(data):
+    """Start a new interpreter for each startup command, which is mostly
+  import time.
+  """
+    for command in STARTUP_COMMANDS:
+        subprocess.check_call([sys.executable] + command, stdout=subprocess.DEVNULL)
+    return len(STARTUP_COMMANDS)
+
+
+def bench_decode(data):
+    for filename in data.game_files:
+        load_im(filename)
+    return len(data.game_files)
+
+
+def bench_decode_cards(data):
+    for filename in data.card_files:
+        load_im(filename)
+    return len(data.card_files)
+
+
+def bench_packed_cards(data):
+    # what a fresh process pays: open the pack, then copy each card out of
+    # the mapping
+    pack = get_pack("game-cards", reload=True)
+    for filename in data.card_files:
+        np.array(pack.image(os.path.relpath(filename, pack.src_dir)))
+    return len(data.card_files)
+
+
+def bench_find_cards(data):
+    for im in data.game_ims:
+        list(find_cards(im, with_corners=True))
+    return len(data.game_ims)
+
+
+def bench_find_cards_full(data):
+    for im in data.game_ims:
+        list(find_cards(im, with_corners=True, detect_max_dim=None))
+    return len(data.game_ims)
+
+
+def bench_warp_whole_image(data):
+    """Each card warped over the whole image, as find_cards used to."""
+    w, h = CARD_WIDTH, CARD_HEIGHT
+    corners = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]], np.float32)
+    cards = 0
+    for im, quads in zip(data.game_ims, data.game_quads):
+        for quad in quads:
+            transform = cv2.getPerspectiveTransform(quad, corners)
+            cv2.warpPerspective(im, transform, (w, h))
+        cards += len(quads)
+    return cards
+
+
+def bench_warp_cards(data):
+    cards = 0
+    for im, quads in zip(data.game_ims, data.game_quads):
+        for quad in quads:
+            warp_quad(im, quad, CARD_WIDTH, CARD_HEIGHT)
+        cards += len(quads)
+    return cards
+
+
+def bench_warp_cards_batch(data):
+    cards = 0
+    for im, quads in zip(data.game_ims, data.game_quads):
+        warp_quads(im, quads, CARD_WIDTH, CARD_HEIGHT)
+        cards += len(quads)
+    return cards
+
+
+def bench_extract_shapes(data):
+    for im in data.card_ims:
+        extract_shapes_from_im(im)
+    return len(data.card_ims)
+
+
+def bench_orb_matching(data):
+    get_template_bank()
+    for im in data.card_ims:
+        get_best_orb_matches(im, canny=True)
+        get_best_orb_matches(im)
+    return len(data.card_ims)
+
+
+def bench_cascade_matching(data):
+    get_template_bank()
+    for im in data.card_ims:
+        color = classify_color(im)
+        get_best_orb_matches(im, canny=True, color=color, margin=CASCADE_MARGIN)
+        get_best_orb_matches(im, color=color, margin=CASCADE_MARGIN)
+    return len(data.card_ims)
+
+
+def bench_analytic(data):
+    for im in data.card_ims:
+        classify_number_shade_shape(im)
+    return len(data.card_ims)
+
+
+def bench_color(data):
+    for im in data.card_ims:
+        classify_color(im)
+    return len(data.card_ims)
+
+
+def bench_find_sets(data):
+    for labels in data.game_labels:
+        ENCODING.find_sets([ENCODING.encode(label) for label in labels])
+    # a full deck, as the largest possible board
+    ENCODING.find_sets(list(range(81)))
+    return len(data.game_labels) + 1
+
+
+# name -> function running the stage once over its inputs, returning how
+# many items it processed
+STAGES = OrderedDict(
+    [
+        ("startup", bench_startup),
+        ("decode", bench_decode),
+        ("decode_cards", bench_decode_cards),
+        ("packed_cards", bench_packed_cards),
+        ("find_cards", bench_find_cards),
+        ("find_cards_full", bench_find_cards_full),
+        ("warp_whole_image", bench_warp_whole_image),
+        ("warp_cards", bench_warp_cards),
+        ("warp_cards_batch", bench_warp_cards_batch),
+        ("extract_shapes", bench_extract_shapes),
+        ("orb_matching", bench_orb_matching),
+        ("cascade_matching", bench_cascade_matching),
+        ("analytic", bench_analytic),
+        ("color", bench_color),
+        ("find_sets", bench_find_sets),
+    ]
+)
+
+
+def stdev(ns):
+    avg = mean(ns)
+    return (sum([(n - avg) ** 2 for n in ns]) / (len(ns) or 1)) ** 0.5
+
+
+def time_stage(stage_fn, data, repeat=3, warmup=1):
+    """Run a stage warmup times untimed, then repeat times timed. Returns
+  statistics of the repeat run times, in seconds.
+  """
+    for _ in range(warmup):
+        stage_fn(data)
+
+    times = []
+    items = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = stage_fn(data)
+        times.append(time.perf_counter() - start)
+
+    med = median(sorted(times))
+    return OrderedDict(
+        [
+            ("items", items),
+            ("repeat", repeat),
+            ("min", min(times)),
+            ("median", med),
+            ("mean", mean(times)),
+            ("stdev", stdev(times)),
+            ("per_item", med / (items or 1)),
+        ]
+    )
+
+
+def run_benchmarks(stage_names, data, repeat=3, warmup=1, quiet=False):
+    results = OrderedDict()
+    for name in stage_names:
+        results[name] = time_stage(STAGES[name], data, repeat=repeat, warmup=warmup)
+        if not quiet:
+            print_stage(name, results[name])
+    return OrderedDict([("meta", environment()), ("stages", results)])
+
+
+def environment():
+    return OrderedDict(
+        [
+            ("time", time.strftime("%Y-%m-%dT%H:%M:%S")),
+            ("python", platform.python_version()),
+            ("platform", platform.platform()),
+            ("opencv", cv2.__version__),
+            ("numpy", np.__version__),
+            ("cpus", os.cpu_count()),
+        ]
+    )
+
+
+def print_stage(name, stats):
+    print(
+        "{:<16} {:>4} items  median {:8.4f}s  min {:8.4f}s  "
+        "stdev {:7.4f}s  per item {:8.5f}s".format(
+            name,
+            stats["items"],
+            stats["median"],
+            stats["min"],
+            stats["stdev"],
+            stats["per_item"],
+        )
+    )
+
+
+def compare_detection(data, detect_max_dim=DETECT_MAX_DIM):
+    """Compare cards found at detect_max_dim against cards found at full
+  size: count per image, and the distance between the corners of cards
+  found by both. Returns the largest corner error, in full size pixels.
+  """
+    print(
+        "\n{:<20} {:>6} {:>6} {:>14} {:>14}".format(
+            "image", "full", "reduced", "mean err px", "max err px"
+        )
+    )
+    worst = 0.0
+    for filename, im in zip(data.game_files, data.game_ims):
+        full = [c for _, c in find_cards(im, with_corners=True, detect_max_dim=None)]
+        reduced = [
+            c
+            for _, c in find_cards(im, with_corners=True, detect_max_dim=detect_max_dim)
+        ]
+        errors = []
+        for corners in reduced:
+            # the same card found at full size is the one with the nearest center
+            dists = [
+                np.linalg.norm(c.mean(axis=0) - corners.mean(axis=0)) for c in full
+            ]
+            if dists:
+                match = full[int(np.argmin(dists))]
+                errors.append(np.linalg.norm(match - corners, axis=1).max())
+        mean_err = mean(errors) if errors else 0.0
+        max_err = max(errors) if errors else 0.0
+        worst = max(worst, max_err)
+        print(
+            "{:<20} {:>6} {:>6} {:>14.2f} {:>14.2f}".format(
+                os.path.basename(filename), len(full), len(reduced), mean_err, max_err
+            )
+        )
+    return worst
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Compare each stage's median per item time against the baseline.
+  Returns the names of the stages that got slower by more than tolerance.
+  """
+    regressions = []
+    print("\n{:<16} {:>12} {:>12} {:>8}".format("stage", "baseline", "now", "ratio"))
+    for name, stats in results["stages"].items():
+        base = baseline["stages"].get(name)
+        if not base:
+            print("{:<16} {:>12} {:>12.5f}".format(name, "-", stats["per_item"]))
+            continue
+        ratio = stats["per_item"] / (base["per_item"] or 1e-12)
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(
+            "{:<16} {:>12.5f} {:>12.5f} {:>7.2f}x{}".format(
+                name, base["per_item"], stats["per_item"], ratio, flag
+            )
+        )
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of the SET solver pipeline."
+    )
+    parser.add_argument(
+        "--stages",
+        dest="stages",
+        type=str,
+        default=",".join(STAGES.keys()),
+        help="Comma separated stages to run (default: all of %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat", dest="repeat", type=int, default=3, help="Timed runs per stage"
+    )
+    parser.add_argument(
+        "--warmup", dest="warmup", type=int, default=1, help="Untimed runs per stage"
+    )
+    parser.add_argument(
+        "--detection",
+        dest="detection",
+        action="store_true",
+        help="Compare cards found at --detect-max-dim against full size",
+    )
+    parser.add_argument(
+        "--detect-max-dim",
+        dest="detect_max_dim",
+        type=int,
+        default=DETECT_MAX_DIM,
+        help="Detection size for --detection (default %(default)s)",
+    )
+    parser.add_argument(
+        "--save", dest="save", type=str, help="Write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--compare",
+        dest="compare",
+        type=str,
+        help="Compare against this baseline JSON file, exit 1 on regressions",
+    )
+    parser.add_argument(
+        "--tolerance",
+        dest="tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Allowed slowdown before flagging a regression (default %(default)s)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+
+    stage_names = [s for s in args.stages.split(",") if s]
+    unknown = [s for s in stage_names if s not in STAGES]
+    if unknown:
+        print("Error: unknown stages {}".format(", ".join(unknown)))
+        sys.exit(1)
+
+    data = BenchData()
+    results = run_benchmarks(stage_names, data, args.repeat, args.warmup)
+
+    if args.detection:
+        compare_detection(data, args.detect_max_dim)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print("\nWrote {}".format(args.save))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
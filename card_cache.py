@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""Cache card classifications by a perceptual signature of the card image,
+so a card that was already classified is not run through ORB matching and
+noteshrink again when it shows up in another photo or frame. Each engine's
+classifications, with their confidence, are kept apart.
+
+The signature describes what the card shows rather than its pixels, so
+it holds up across photos: the outline of its shapes (their filled
+silhouettes, cropped to where they are on the card and thumbnailed), how
+much of their inside is inked compared to their border (the shade), and
+the color of the ink. Colors are measured against the card's own white,
+so lighting and white balance don't change them. Lookups match the
+nearest stored signature within max_distance.
+
+On image-data/set-game-cards and image-data/all-cards/labeled, the same
+card in two different photos is within DEFAULT_MAX_DISTANCE in 89 of 108
+pairs, and no two different cards are, the closest being a card whose
+shapes are mostly lost to glare. Cards rotated by a few degrees or shrunk
+by a fifth in the same photo are all found.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+from contours import find_contours
+from classify_card import (
+    DEFAULT_ENGINE,
+    ENGINES,
+    CardClassification,
+    TemplateBank,
+    classify_card_with_confidence,
+)
+from common import ALL_SHAPES_DIR, label_to_dict
+
+# bump when the signature or the classifier changes in a way that makes
+# stored labels stale
+CACHE_VERSION = 3
+
+DEFAULT_MAX_ENTRIES = 4096
+DEFAULT_MAX_DISTANCE = 0.22
+
+# fraction of the card cut off each side, so the table around the card and
+# its rounded corners don't affect the signature
+SIGNATURE_INSET = 0.08
+# size the card's inner region is measured at
+SIGNATURE_WORK_SIZE = (150, 100)
+# size of the thumbnail of the shapes' silhouettes
+SIGNATURE_SIZE = (24, 16)
+# brightness percentile, per channel, taken as the card's white
+WHITE_PERCENTILE = 90
+# ink, from 0 (white) to 1 (the card's darkest ink), that counts as shape
+INK_THRESHOLD = 0.5
+# smallest shape, as a fraction of the card's inner region
+MIN_SHAPE_AREA = 0.01
+# width of a shape's border, in pixels at SIGNATURE_WORK_SIZE
+BORDER_WIDTH = 3
+# weights of the shade and the ink color against the unit length thumbnail
+SHADE_WEIGHT = 2.5
+COLOR_WEIGHT = 1.5
+
+
+def card_signature(card_im):
+    """float32 vector describing the card image's shapes, shade and color, or
+  None if no shapes can be made out.
+  """
+    h, w = card_im.shape[:2]
+    dy, dx = int(h * SIGNATURE_INSET), int(w * SIGNATURE_INSET)
+    im = card_im[dy : h - dy, dx : w - dx]
+    im = cv2.resize(im, SIGNATURE_WORK_SIZE, interpolation=cv2.INTER_AREA)
+
+    # each channel relative to the card's white, and the ink's strength from
+    # the darkest channel, relative to the darkest ink on the card
+    im = im.astype(np.float32)
+    white = np.percentile(im.reshape(-1, 3), WHITE_PERCENTILE, axis=0) + 1
+    im = np.clip(im / white, 0, 1)
+    ink = 1 - im.min(axis=2)
+    ink = np.clip(ink / max(np.percentile(ink, 99), 0.05), 0, 1)
+
+    mask = (ink > INK_THRESHOLD).astype(np.uint8)
+    found, _ = find_contours(mask, cv2.RETR_EXTERNAL)
+    found = [c for c in found if cv2.contourArea(c) > MIN_SHAPE_AREA * mask.size]
+    if not found:
+        return None
+    silhouettes = np.zeros_like(mask)
+    cv2.drawContours(silhouettes, found, -1, 1, -1)
+
+    # the shapes fit into the thumbnail without changing their proportions,
+    # so where they sit on the card and how big they are don't matter
+    x, y, w, h = cv2.boundingRect(np.vstack(found))
+    thumb_w, thumb_h = SIGNATURE_SIZE
+    scale = min(thumb_w / float(w), thumb_h / float(h))
+    fit = np.float32(
+        [
+            [scale, 0, thumb_w / 2.0 - scale * (x + w / 2.0)],
+            [0, scale, thumb_h / 2.0 - scale * (y + h / 2.0)],
+        ]
+    )
+    # blurred by most of a thumbnail pixel, for small rotations
+    thumb = cv2.GaussianBlur(silhouettes.astype(np.float32), (0, 0), 0.75 / scale)
+    thumb = cv2.warpAffine(thumb, fit, SIGNATURE_SIZE).flatten()
+    thumb -= thumb.mean()
+    thumb /= np.linalg.norm(thumb) or 1
+
+    size = 2 * BORDER_WIDTH + 1
+    inside = cv2.erode(silhouettes, np.ones((size, size), np.uint8)).astype(bool)
+    border = silhouettes.astype(bool) & ~inside
+    shade = 0.0
+    if inside.any():
+        shade = min(1.0, ink[inside].mean() / max(ink[border].mean(), 0.05))
+
+    weights = (ink * silhouettes)[..., None]
+    color = 1 - (im * weights).sum(axis=(0, 1)) / (weights.sum() or 1)
+    color /= np.linalg.norm(color) or 1
+
+    sig = np.concatenate([thumb, [SHADE_WEIGHT * shade], COLOR_WEIGHT * color])
+    return sig.astype(np.float32)
+
+
+def signature_key(sig):
+    """Exact key for a signature, used to store it."""
+    return hashlib.sha1(np.round(sig * 1e4).astype(np.int32).tobytes()).hexdigest()
+
+
+def classifier_namespace(engine=DEFAULT_ENGINE, shapes_dir=ALL_SHAPES_DIR):
+    """Identifies the classifier engine and template set labels were produced
+  with; entries are only looked up by the same engine, and ones from other
+  template sets or cache versions are pruned.
+  """
+    signature = "{}|{}|{}".format(
+        CACHE_VERSION, engine, TemplateBank.dir_signature(shapes_dir)
+    )
+    return hashlib.sha1(signature.encode("utf-8")).hexdigest()[:16]
+
+
+class CardCache(object):
+    """In-memory LRU of card signatures and their classifications (see
+  classify_card.CardClassification), bounded to max_entries across all
+  engines, optionally persisted to an sqlite file at path so it survives
+  restarts. Safe to share between threads.
+  """
+
+    def __init__(
+        self,
+        path=None,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        max_distance=DEFAULT_MAX_DISTANCE,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.namespaces = {engine: classifier_namespace(engine) for engine in ENGINES}
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # (namespace, key) -> row of self._sigs, in least to most recently
+        # used order
+        self._slots = OrderedDict()
+        self._classifications = {}
+        self._sigs = None
+        self._free = []
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(cards)")]
+            # tables from before confidence was stored can't be trusted by
+            # headless solves
+            if columns and "confidence" not in columns:
+                self._db.execute("DROP TABLE cards")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cards (namespace TEXT, key TEXT, "
+                "signature BLOB, label TEXT, confidence TEXT, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            # labels from other templates or classifier versions are stale
+            namespaces = list(self.namespaces.values())
+            self._db.execute(
+                "DELETE FROM cards WHERE namespace NOT IN ({})".format(
+                    ", ".join("?" * len(namespaces))
+                ),
+                namespaces,
+            )
+            self._db.commit()
+            rows = self._db.execute(
+                "SELECT namespace, key, signature, label, confidence FROM cards "
+                "ORDER BY rowid DESC LIMIT ?",
+                (max_entries,),
+            ).fetchall()
+            for namespace, key, sig, label, confidence in reversed(rows):
+                classification = CardClassification(
+                    label_to_dict(label), json.loads(confidence)
+                )
+                self._insert(
+                    (namespace, key), np.frombuffer(sig, np.float32), classification
+                )
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _insert(self, key, sig, classification):
+        if key in self._slots:
+            self._slots.move_to_end(key)
+            self._classifications[key] = classification
+            return
+        if self._sigs is None:
+            self._sigs = np.zeros((self.max_entries, len(sig)), np.float32)
+            self._free = list(range(self.max_entries - 1, -1, -1))
+        if not self._free:
+            # evict the least recently used entry
+            old_key, old_slot = self._slots.popitem(last=False)
+            del self._classifications[old_key]
+            self._free.append(old_slot)
+        slot = self._free.pop()
+        self._sigs[slot] = sig
+        self._slots[key] = slot
+        self._classifications[key] = classification
+
+    def _nearest(self, sig, namespace):
+        """Key of the closest signature stored in namespace within
+    max_distance, or None.
+    """
+        entries = [(k, s) for k, s in self._slots.items() if k[0] == namespace]
+        if not entries:
+            return None
+        keys, slots = zip(*entries)
+        dists = np.linalg.norm(self._sigs[list(slots)] - sig, axis=1)
+        i = int(dists.argmin())
+        return keys[i] if dists[i] <= self.max_distance else None
+
+    def get(self, card_im, engine=DEFAULT_ENGINE):
+        """CardClassification engine gave a cached card that looks like
+    card_im, or None.
+    """
+        namespace = self.namespaces[engine]
+        sig = card_signature(card_im)
+        # warps can come out in either landscape orientation
+        flipped = card_signature(card_im[::-1, ::-1])
+        with self._lock:
+            key = None
+            if sig is not None:
+                key = self._nearest(sig, namespace) or self._nearest(flipped, namespace)
+            if key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._slots.move_to_end(key)
+            return self._classifications[key]
+
+    def put(self, card_im, classification, engine=DEFAULT_ENGINE):
+        """Store engine's CardClassification of card_im, which must have a
+    label. Cards without shapes to make out aren't stored.
+    """
+        namespace = self.namespaces[engine]
+        sig = card_signature(card_im)
+        if sig is None:
+            return
+        key = signature_key(sig)
+        with self._lock:
+            self._insert((namespace, key), sig, classification)
+            if self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?)",
+                    (
+                        namespace,
+                        key,
+                        sig.astype(np.float32).tobytes(),
+                        classification.label,
+                        json.dumps(classification.confidence),
+                    ),
+                )
+                self._db.commit()
+
+    def classify(self, card_im, engine=DEFAULT_ENGINE):
+        """Cached label for card_im, classifying it with engine (asking for
+    attributes it can't classify) and storing it on a miss.
+    """
+        classification = self.get(card_im, engine)
+        if classification is None:
+            classification = classify_card_with_confidence(card_im, engine, ask=True)
+            if classification.label:
+                self.put(card_im, classification, engine)
+        return classification.label
+
+    def invalidate(self):
+        """Forget every entry, in memory and on disk, for example after
+    changing image-data/all-shapes in a running process.
+    """
+        with self._lock:
+            self.namespaces = {e: classifier_namespace(e) for e in ENGINES}
+            self._slots.clear()
+            self._classifications.clear()
+            self._sigs = None
+            self._free = []
+            if self._db:
+                self._db.execute("DELETE FROM cards")
+                self._db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self),
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Features of a card image that the attribute classifiers need, computed
+once per card and shared between them."""
+
+import cv2
+from extract_shapes import extract_shapes_from_im, find_shape_contours
+from process_card import noteshrink_card_labels
+from vendor.noteshrink import CannotGetPalette
+
+# parameters shared by template and card descriptors
+ORB_EDGE_THRESHOLD = 5
+CANNY_MIN = 100
+CANNY_MAX = 200
+
+
+def orb_descriptors(gray_im, canny=False):
+    """Compute ORB descriptors for a grayscale image, or for its edges if
+  canny is set. Returns None if no keypoints were found.
+  """
+    if canny:
+        gray_im = cv2.Canny(gray_im, CANNY_MIN, CANNY_MAX)
+
+    orb = cv2.ORB_create()
+    orb.setEdgeThreshold(ORB_EDGE_THRESHOLD)
+
+    _, des = orb.detectAndCompute(gray_im, None)
+    return des
+
+
+class Segment(object):
+    """One shape cut out of a card, with its grayscale, edge and ORB
+  descriptor versions computed on first use.
+  """
+
+    def __init__(self, im):
+        self.im = im
+        self._gray = None
+        self._edges = None
+        # {canny: descriptors}, None values are valid (no keypoints)
+        self._descriptors = {}
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.im, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def edges(self):
+        if self._edges is None:
+            self._edges = cv2.Canny(self.gray, CANNY_MIN, CANNY_MAX)
+        return self._edges
+
+    def descriptors(self, canny=False):
+        if canny not in self._descriptors:
+            im = self.edges if canny else self.gray
+            self._descriptors[canny] = orb_descriptors(im)
+        return self._descriptors[canny]
+
+
+class CardFeatures(object):
+    """Everything the shape, shade, number and color classifiers read from a
+  card image. Each feature is computed the first time it is asked for.
+  """
+
+    def __init__(self, im):
+        self.im = im
+        self._gray = None
+        self._contours = None
+        self._thresh = None
+        self._segments = None
+        self._noteshrunk = None
+        self._noteshrink_error = None
+
+    @classmethod
+    def of(cls, card):
+        """Accept either a card image or already computed features."""
+        return card if isinstance(card, cls) else cls(card)
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.im, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def contours(self):
+        """Outer contours of the dark regions of the card, largest first."""
+        if self._contours is None:
+            self._thresh, self._contours = find_shape_contours(self.gray, keep=True)
+        return self._contours
+
+    @property
+    def thresh(self):
+        """The card thresholded so shape ink is white, as used for contours."""
+        if self._thresh is None:
+            self._thresh, self._contours = find_shape_contours(self.gray, keep=True)
+        return self._thresh
+
+    @property
+    def segments(self):
+        """The 1 to 3 shapes on the card, largest first."""
+        if self._segments is None:
+            shapes = extract_shapes_from_im(self.im, contours=self.contours)
+            self._segments = [Segment(im) for im in shapes]
+        return self._segments
+
+    def noteshrunk(self):
+        """(labels, palette) of the noteshrunk card, see
+    process_card.noteshrink_card_labels. Failures are remembered and raised
+    again on later calls.
+    """
+        if self._noteshrunk is None and self._noteshrink_error is None:
+            try:
+                self._noteshrunk = noteshrink_card_labels(self.im)
+            except CannotGetPalette as e:
+                self._noteshrink_error = e
+        if self._noteshrink_error is not None:
+            raise self._noteshrink_error
+        return self._noteshrunk
@@ -10,113 +10,296 @@ import shutil
 import sys
 import cv2
 import numpy as np
+import instrument
 from common import (
     CARD_FINDER_OUT_DIR,
     CARD_WIDTH,
     CARD_HEIGHT,
     game_img_filename,
     clean_make_dir,
+    load_im,
     write_im,
     display_im,
     mean,
     median,
+    quad_roi,
     rectify,
+    warp_quad,
+    warp_quads,
 )
-
-# technically there's a possibility of 18 cards required:
-# https://norvig.com/SET.html
-# but we'll simplify the problem for now
-MAXCARDS = 15
+from contours import extract_contours, find_contours, get_extractor
 
 OUT_FILE_FMT = "card{}.jpg"
 
-# min channel cutoff for the threshold filter
-THRESH_MIN = 180
-# how much a contour's area can differ from the mean of the top MAXCARDS
+# how much a card's area can differ from the median card area
 CONTOUR_AREA_TOLERANCE = 2.5
-
-
-def remove_contour_outliers(contours):
+# contours smaller than this fraction of the image are never cards; at
+# 1000 pixels this still allows boards of well over 81 cards
+MIN_CARD_AREA = 0.001
+# ...nor are quads larger than this fraction, like a light table around the
+# mat the cards lie on (a close-up of a single card is under half)
+MAX_CARD_AREA = 0.75
+
+# cards are found in a copy of the image no larger than this, then their
+# corners are refined at full size; None finds them at full size
+DETECT_MAX_DIM = 1000
+# margin around a card found at detection size that is searched for its
+# full size outline, in detection size pixels
+REFINE_MARGIN = 4
+
+
+def remove_contour_outliers(contours, areas=None):
     """Remove contours that differ greatly from the median size.
-  If most of the top contours are cards, this gets rid of overly large
-  or small polygons that are likely not cards.
+  If most of the contours are cards, this gets rid of overly large
+  or small polygons that are likely not cards. areas are the contours'
+  areas, if already computed. Returns the kept contours and their areas.
   """
-    # get median of largest contour areas
-    med = median([cv2.contourArea(contours[i]) for i in range(MAXCARDS)])
-
-    def area_filter(c, tolerance=CONTOUR_AREA_TOLERANCE):
-        """Remove this contour if area is too far from the median."""
-        c_area = cv2.contourArea(c)
-        return ((1 / tolerance) * med < c_area) and (c_area < tolerance * med)
-
-    contours = list(filter(area_filter, contours))
-    return contours
+    if areas is None:
+        areas = [cv2.contourArea(c) for c in contours]
+    if not len(contours):
+        return [], []
+    med = median(sorted(areas))
+
+    kept = [
+        (c, area)
+        for c, area in zip(contours, areas)
+        if med / CONTOUR_AREA_TOLERANCE < area < CONTOUR_AREA_TOLERANCE * med
+    ]
+    return [c for c, _ in kept], [area for _, area in kept]
+
+
+def card_candidates(thresh):
+    """Find the outlines of cards in a thresholded image, largest first, as
+  rectified quads. Each contour's area is computed once, contours nested in
+  a quad that is already a candidate (the shapes on a card, and their
+  insides) are dropped, and there is no limit on the number of cards.
+
+  Only the outer outlines of light areas can be cards, not the holes in
+  them (like a dark mat on a light table). Quads larger than MAX_CARD_AREA
+  never hide the contours inside them, and neither do the outliers
+  remove_contour_outliers finds: the candidates are found again without
+  them until no outlier hides anything.
+
+  Returns (candidates, misses), where misses are the contours about as
+  large as the candidates that aren't quads, for find_cards to look for
+  cards in again at full size.
+  """
+    contours, hierarchy = find_contours(thresh, cv2.RETR_TREE)
+    instrument.count("contours_considered", len(contours))
+    if not contours:
+        return [], []
+    # [next, previous, first child, parent] for each contour
+    parents = hierarchy[0][:, 3]
+
+    image_area = thresh.shape[0] * thresh.shape[1]
+    min_area = MIN_CARD_AREA * image_area
+    max_area = MAX_CARD_AREA * image_area
+    areas = np.array([cv2.contourArea(c) for c in contours])
+    # holes are at odd depths of the tree, light areas at even ones
+    depths = np.zeros(len(contours), np.int32)
+    for i in range(len(contours)):
+        parent = parents[i]
+        while parent >= 0:
+            depths[i] += 1
+            parent = parents[parent]
+    # contour index -> its approximation, if it is a quad, else None
+    approxes = {}
+    # quads that are not cards
+    rejected = set()
+    while True:
+        # parents before their children, so any nested quad is seen after
+        # its enclosing candidate
+        quads = {}
+        # candidate -> how many contours nested in it were dropped
+        hidden = {}
+        # contours that aren't nested in a candidate, nor quads themselves
+        shapeless = []
+        for i in np.argsort(-areas, kind="stable"):
+            if areas[i] < min_area:
+                break
+            if areas[i] > max_area or depths[i] % 2 or i in rejected:
+                continue
+            parent = parents[i]
+            while parent >= 0 and parent not in quads:
+                parent = parents[parent]
+            if parent >= 0:
+                hidden[parent] += 1
+                continue
+            if i not in approxes:
+                peri = cv2.arcLength(contours[i], True)
+                approx = cv2.approxPolyDP(contours[i], 0.1 * peri, True)
+                # quadrangles only
+                approxes[i] = approx if len(approx) == 4 else None
+            if approxes[i] is not None:
+                quads[i] = approxes[i]
+                hidden[i] = 0
+            else:
+                shapeless.append(i)
+
+        order = sorted(quads, key=lambda i: -areas[i])
+        kept, _ = remove_contour_outliers(order, [areas[i] for i in order])
+        outliers = set(order) - set(kept)
+        if not any(hidden[i] for i in outliers):
+            break
+        rejected |= outliers
+
+    misses = []
+    if kept:
+        med = median(sorted(areas[i] for i in kept))
+        misses = [
+            contours[i]
+            for i in shapeless
+            if med / CONTOUR_AREA_TOLERANCE < areas[i] < CONTOUR_AREA_TOLERANCE * med
+        ]
+    # order each of the 4 points uniformly, rotating if necessary
+    return [rectify(quads[i]) for i in kept], misses
+
+
+def detection_image(orig_im, detect_max_dim=DETECT_MAX_DIM):
+    """Grayscale version of orig_im to find cards in, no larger than
+  detect_max_dim, and the integer factor it was shrunk by. At full size it
+  is the thread's scratch gray image, valid until its next use.
+  """
+    gray = get_extractor().gray(orig_im)
+    h, w = gray.shape
+    factor = -(-max(h, w) // detect_max_dim) if detect_max_dim else 1
+    if factor == 1:
+        return gray, 1
+    # INTER_AREA is much faster by an exact integer factor, so crop the few
+    # rows and columns that don't fit it
+    gray = gray[: h - h % factor, : w - w % factor]
+    small = cv2.resize(gray, (w // factor, h // factor), interpolation=cv2.INTER_AREA)
+    return small, factor
+
+
+def refine_quad(orig_im, quad, margin):
+    """Find the card outline near quad in the full size image, returning its
+  corners, or quad itself if no matching outline is found.
+  """
+    roi, offset = quad_roi(orig_im, quad, margin)
+    _, contours, _ = extract_contours(roi)
+    if not contours:
+        return quad
+
+    card = max(contours, key=cv2.contourArea)
+    approx = cv2.approxPolyDP(card, 0.1 * cv2.arcLength(card, True), True)
+    if len(approx) != 4:
+        return quad
+    refined = rectify(approx) + offset
+    # a neighbouring card or a different outline, not the same card
+    if np.abs(refined - quad).max() > 2 * margin:
+        return quad
+    return refined
+
+
+def recover_quad(orig_im, contour, factor, card_area):
+    """Look for a card in the full size image around contour, found at
+  detection size (shrunk by factor) but not a quad there, like a card half
+  in shadow that shrinking the image broke up. Returns its corners, or None
+  if the largest outline there isn't a quad within CONTOUR_AREA_TOLERANCE of
+  card_area (in full size pixels) covering the contour's center.
+  """
+    x, y, w, h = cv2.boundingRect(contour)
+    box = np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]], np.float32)
+    # the card may reach well past the part of it that was found
+    roi, offset = quad_roi(orig_im, box * factor, max(w, h) * factor // 4)
+    _, contours, _ = extract_contours(roi)
+    if not contours:
+        return None
+
+    card = max(contours, key=cv2.contourArea)
+    area = cv2.contourArea(card) / card_area
+    if not 1 / CONTOUR_AREA_TOLERANCE < area < CONTOUR_AREA_TOLERANCE:
+        return None
+    approx = cv2.approxPolyDP(card, 0.1 * cv2.arcLength(card, True), True)
+    if len(approx) != 4:
+        return None
+    center = ((x + w / 2.0) * factor - offset[0], (y + h / 2.0) * factor - offset[1])
+    if cv2.pointPolygonTest(approx, center, False) < 0:
+        return None
+    return rectify(approx) + offset
 
 
 def find_cards(
-    filename,
+    src,
     out_w=CARD_WIDTH,
     out_h=CARD_HEIGHT,
     display_points=False,
     with_corners=False,
+    detect_max_dim=DETECT_MAX_DIM,
+    batch_warp=False,
 ):
-    """Find SET game cards in image and return as a list of images."""
-    # 1 = color, 0 = gray, -1 = color+alpha
-    orig_im = cv2.imread(filename, 1)
-    im = cv2.imread(filename, 0)
-
-    # this may be useful later
-    # avg_brightness = mean([mean(row) for row in im])
-
-    # filters to make it easier for opencv to find card
-    blur = cv2.GaussianBlur(im, (1, 1), 1000)
-
-    flag, thresh = cv2.threshold(blur, THRESH_MIN, 255, cv2.THRESH_BINARY)
-
-    # `image` is the thrown away value
-    _, contours, hierarchy = cv2.findContours(
-        thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
-    )
-
-    # sort contours by largest volume
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)
-
-    # throw out contours that are far from the median size
-    contours = remove_contour_outliers(contours)
-
-    # will likely never have < MAXCARDS contours (unless solid black or similar)
-    for i in range(min(MAXCARDS, len(contours))):
-        card = contours[i]
-        peri = cv2.arcLength(card, True)
-        approx = cv2.approxPolyDP(card, 0.1 * peri, True)
-
-        # quadrangles only
-        if len(approx) == 4:
-
-            # order each of the 4 points uniformly, rotating if necessary
-            approx = rectify(approx)
-
-            if display_points:
-                for point in approx:
-                    cv2.circle(
-                        orig_im, (point[0], point[1]), 0, (0, 0, 255), im.shape[0] / 100
-                    )
-
-            # create an image of just the card
-            h = np.array(
-                [[0, 0], [out_w - 1, 0], [out_w - 1, out_h - 1], [0, out_h - 1]],
-                np.float32,
-            )
-            transform = cv2.getPerspectiveTransform(approx, h)
-            warp = cv2.warpPerspective(orig_im, transform, (out_w, out_h))
-            if not display_points:
-                if with_corners:
-                    yield (warp, approx)
-                else:
-                    yield warp
+    """Find SET game cards in image and return as a list of images. src can be
+  a filename, encoded image bytes or an already decoded BGR image; either way
+  the image is decoded only once.
+
+  Cards are found in a copy of the image shrunk to detect_max_dim (None for
+  full size), then their corners are refined in the full size image, which
+  the card images are cut from, and where a card sized outline found at
+  detection size isn't a quad, a card is looked for there at full size.
+  Each card is warped from just the region around it; with batch_warp, all
+  of them are warped together up front into one array, instead of one at a
+  time as they are yielded.
+  """
+    orig_im = load_im(src)
+    if orig_im is None:
+        name = src if isinstance(src, str) else "from bytes"
+        raise IOError("Cannot read image {}".format(name))
+    if display_points:
+        # don't draw on the caller's image
+        orig_im = orig_im.copy()
+    with instrument.span("find_cards.contours"):
+        im, factor = detection_image(orig_im, detect_max_dim)
+
+        # this may be useful later
+        # avg_brightness = mean([mean(row) for row in im])
+
+        thresh = get_extractor().threshold(im)
+        candidates, misses = card_candidates(thresh)
+
+    margin = REFINE_MARGIN * factor
+    if factor > 1:
+        with instrument.span("find_cards.refine"):
+            # pixel centers of the detection image in full size pixels
+            candidates = [
+                refine_quad(orig_im, (approx + 0.5) * factor - 0.5, margin)
+                for approx in candidates
+            ]
+            if misses:
+                card_area = median(sorted(cv2.contourArea(q) for q in candidates))
+            for contour in misses:
+                approx = recover_quad(orig_im, contour, factor, card_area)
+                if approx is not None:
+                    candidates.append(approx)
 
     if display_points:
+        for approx in candidates:
+            for point in approx:
+                cv2.circle(
+                    orig_im,
+                    (point[0], point[1]),
+                    0,
+                    (0, 0, 255),
+                    orig_im.shape[0] / 100,
+                )
         display_im(orig_im)
+        return
+
+    if batch_warp:
+        with instrument.span("find_cards.warp"):
+            warps = warp_quads(orig_im, candidates, out_w, out_h)
+    for i, approx in enumerate(candidates):
+        if batch_warp:
+            warp = warps[i]
+        else:
+            # create an image of just the card
+            with instrument.span("find_cards.warp"):
+                warp = warp_quad(orig_im, approx, out_w, out_h)
+        instrument.count("cards_found")
+        if with_corners:
+            yield (warp, approx)
+        else:
+            yield warp
 
 
 def write_cards(cards, out_dir=CARD_FINDER_OUT_DIR, out_file=OUT_FILE_FMT):
@@ -134,7 +317,7 @@ def write_cards(cards, out_dir=CARD_FINDER_OUT_DIR, out_file=OUT_FILE_FMT):
 
 def get_args():
     """Argument parser
-  game_file:    image with up to MAXCARDS set cards
+  game_file:    image with set cards
   write:        write output images to files
   display:      show images using cv2.imshow()
   """
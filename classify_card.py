@@ -1,34 +1,70 @@
 #!/usr/bin/env python
 """Classify a SET card image's color, shape, shade, number."""
 
+import hashlib
 import os
 import sys
+import threading
 import cv2
-from extract_shapes import extract_shapes_from_im
-from label_all_cards import manually_label_card
-from process_card import noteshrink_card_from_im
-from common import ALL_SHAPES_DIR, mean, jpgs_in_dir
+import numpy as np
+import instrument
+from analytic_classifier import (
+    card_shape_stats,
+    classify_number,
+    classify_shade,
+    classify_shape,
+    number_margin,
+    shade_margin,
+    shape_margin,
+)
+from card_features import CardFeatures, orb_descriptors
+from common import ALL_SHAPES_DIR, CACHE_DIR, jpgs_in_dir
+from engines import DEFAULT_ENGINE, ENGINES, HEADLESS_ENGINE
 from vendor.noteshrink import CannotGetPalette
 
 
-def orb_score(shape_to_find, cv_im, canny=False, min_match_ct=10, thresh_min=100):
-    """Use ORB to get a match score for image file shape_to_find and cv_im."""
-    img1 = cv2.imread(shape_to_find, 0)
-    img2 = cv2.cvtColor(cv_im, cv2.COLOR_BGR2GRAY)
+# how much better (as a fraction) the cascade's best template score must be
+# than the runner-up's to stop matching the card's other shapes
+CASCADE_MARGIN = 0.2
+
+# attributes in the order they appear in labels
+ATTRS = ("color", "number", "shade", "shape")
 
-    if canny:
-        img1 = cv2.Canny(img1, 100, 200)
-        img2 = cv2.Canny(img2, 100, 200)
+# margin (see classify_attrs) each attribute's best guess must win by for
+# full confidence, per engine. Calibrated on image-data/set-game-cards so
+# that MIN_CONFIDENCE (half these) keeps every correct color and number,
+# and drops the shade guesses least likely to be right. A solid card's
+# analytic shade margin is at most (1 - SOLID_MIN_FILL) / SOLID_MIN_FILL,
+# 0.33, so its cutoff must stay below that
+CONFIDENT_MARGINS = {
+    "orb": {"color": 0.8, "number": 1.0, "shade": 0.7, "shape": 0.08},
+    "cascade": {"color": 0.8, "number": 1.0, "shade": 0.7, "shape": 0.08},
+    "analytic": {"color": 0.8, "number": 1.0, "shade": 0.6, "shape": 0.1},
+}
+# cards with any attribute less confident than this go to the review queue
+# rather than being trusted in sets
+MIN_CONFIDENCE = 0.5
 
-    orb = cv2.ORB_create()
-    orb.setEdgeThreshold(5)
+# average shape color of each color, precomputed in avg_colors.py
+COLOR_AVGS = {"red": (0, 34, 226), "green": (64, 123, 0), "purple": (89, 0, 76)}
 
-    kp1, des1 = orb.detectAndCompute(img1, None)
-    kp2, des2 = orb.detectAndCompute(img2, None)
+# bump when the way template descriptors are computed changes, so that
+# banks saved to disk by an older version get rebuilt
+TEMPLATE_BANK_VERSION = 1
 
-    if des2 is None:
-        return
+# only one card can be labeled by hand at a time, even when classifying
+# cards concurrently
+_manual_label_lock = threading.Lock()
 
+# template banks already loaded by this process, keyed by shapes dir
+_template_banks = {}
+_template_banks_lock = threading.Lock()
+
+
+def descriptor_score(des1, des2, min_match_ct=10):
+    """Sum of the distances of the best matches between two sets of ORB
+  descriptors (lower is a closer match).
+  """
     # create BFMatcher object
     bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
     # Match descriptors.
@@ -36,57 +72,262 @@ def orb_score(shape_to_find, cv_im, canny=False, min_match_ct=10, thresh_min=100
     # Sort them in the order of their distance.
     matches = sorted(matches, key=lambda x: x.distance)
 
-    ret = sum([m.distance for m in matches[:min_match_ct]])
+    return sum([m.distance for m in matches[:min_match_ct]])
 
-    return ret
 
+def orb_score(shape_to_find, cv_im, canny=False, min_match_ct=10, thresh_min=100):
+    """Use ORB to get a match score for image file shape_to_find and cv_im."""
+    with instrument.span("orb_score"):
+        img1 = cv2.imread(shape_to_find, 0)
+        img2 = cv2.cvtColor(cv_im, cv2.COLOR_BGR2GRAY)
+
+        des1 = orb_descriptors(img1, canny=canny)
+        des2 = orb_descriptors(img2, canny=canny)
+
+        if des1 is None or des2 is None:
+            return
 
-def get_best_orb_matches(card_im, shapes_dir=ALL_SHAPES_DIR, canny=False):
-    """Test card image against all shapes in shapes_dir, and return tuples
-  (score, label) for the best matches.
+        instrument.count("templates_matched")
+        return descriptor_score(des1, des2, min_match_ct=min_match_ct)
+
+
+class TemplateBank(object):
+    """ORB descriptors of every template shape in a directory, for both the
+  plain and the canny variant, computed once and saved to disk.
   """
-    shapes = jpgs_in_dir(shapes_dir)
 
-    segments = extract_shapes_from_im(card_im)
+    def __init__(self, labels, descriptors, signature):
+        # template filenames, like red-single-solid-diamond.jpg
+        self.labels = labels
+        # {canny: [descriptors for each label, None if no keypoints]}
+        self.descriptors = descriptors
+        # identifies the template files the bank was built from
+        self.signature = signature
+
+    def __len__(self):
+        return len(self.labels)
+
+    def items(self, canny=False):
+        """(label, descriptors) for each template."""
+        return zip(self.labels, self.descriptors[canny])
+
+    @staticmethod
+    def bank_prefix(shapes_dir):
+        """Start of the filename of every bank of shapes_dir. It holds a hash
+    of the directory's absolute path, so directories with the same name
+    don't share banks.
+    """
+        path = os.path.abspath(shapes_dir)
+        path_hash = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+        return "orb-{}-{}-".format(os.path.basename(path), path_hash)
+
+    @classmethod
+    def bank_filename(cls, shapes_dir, signature):
+        """The bank of shapes_dir's templates as of signature."""
+        sig_hash = hashlib.sha1(signature.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(
+            CACHE_DIR, "{}{}.npz".format(cls.bank_prefix(shapes_dir), sig_hash)
+        )
+
+    @staticmethod
+    def dir_signature(shapes_dir):
+        """String that changes whenever a template is added, removed or
+    modified.
+    """
+        parts = ["v{}".format(TEMPLATE_BANK_VERSION)]
+        for shape in sorted(jpgs_in_dir(shapes_dir)):
+            stat = os.stat(os.path.join(shapes_dir, shape))
+            parts.append("{}:{}:{}".format(shape, stat.st_size, stat.st_mtime_ns))
+        return "|".join(parts)
+
+    @classmethod
+    def build(cls, shapes_dir=ALL_SHAPES_DIR):
+        """Compute the descriptors of all templates in shapes_dir."""
+        signature = cls.dir_signature(shapes_dir)
+        labels = sorted(jpgs_in_dir(shapes_dir))
+        descriptors = {False: [], True: []}
+        for shape in labels:
+            gray = cv2.imread(os.path.join(shapes_dir, shape), 0)
+            for canny in descriptors:
+                descriptors[canny].append(orb_descriptors(gray, canny=canny))
+        return cls(labels, descriptors, signature)
+
+    def save(self, filename):
+        """Write the bank as one .npz file, with each variant's descriptors
+    concatenated and split back apart by per-template counts.
+    """
+        arrays = {
+            "labels": np.array(self.labels),
+            "signature": np.array(self.signature),
+        }
+        for canny, key in ((False, "plain"), (True, "canny")):
+            des_list = self.descriptors[canny]
+            counts = [0 if des is None else len(des) for des in des_list]
+            present = [des for des in des_list if des is not None]
+            arrays[key] = (
+                np.vstack(present) if present else np.zeros((0, 32), np.uint8)
+            )
+            arrays[key + "_counts"] = np.array(counts, dtype=np.int32)
+
+        if not os.path.exists(CACHE_DIR):
+            os.mkdir(CACHE_DIR)
+        # write then rename, so concurrent readers never see a partial file
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp_filename, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            labels = [str(label) for label in data["labels"]]
+            signature = str(data["signature"])
+            descriptors = {}
+            for canny, key in ((False, "plain"), (True, "canny")):
+                des_list = []
+                offset = 0
+                for count in data[key + "_counts"]:
+                    des = data[key][offset : offset + count] if count else None
+                    des_list.append(des)
+                    offset += count
+                descriptors[canny] = des_list
+        return cls(labels, descriptors, signature)
+
+
+def get_template_bank(shapes_dir=ALL_SHAPES_DIR, reload=False):
+    """Return the descriptor bank for shapes_dir, loading it at most once per
+  process. The bank on disk is rebuilt if any template file has changed
+  since it was written.
+  """
+    with _template_banks_lock:
+        if shapes_dir in _template_banks and not reload:
+            return _template_banks[shapes_dir]
+
+        signature = TemplateBank.dir_signature(shapes_dir)
+        filename = TemplateBank.bank_filename(shapes_dir, signature)
+        bank = None
+        if os.path.exists(filename):
+            try:
+                bank = TemplateBank.load(filename)
+            except (IOError, KeyError, ValueError):
+                # unreadable or outdated format, rebuild it
+                bank = None
+        if bank is None or bank.signature != signature:
+            bank = TemplateBank.build(shapes_dir)
+            bank.save(filename)
+            # banks of the directory's older templates
+            prefix = TemplateBank.bank_prefix(shapes_dir)
+            for f in os.listdir(CACHE_DIR):
+                path = os.path.join(CACHE_DIR, f)
+                if f.startswith(prefix) and f.endswith(".npz") and path != filename:
+                    os.remove(path)
+
+        _template_banks[shapes_dir] = bank
+        return bank
+
+
+def orb_segment_matches(
+    card, shapes_dir=ALL_SHAPES_DIR, canny=False, color=None, margin=None
+):
+    """For each segment of card image (or its CardFeatures) that has
+  descriptors, every template's (score, label), best first.
+
+  With color, only that color's templates are scored. With margin, once a
+  segment's best score beats its runner-up by that fraction of the
+  runner-up, the card's other segments (the same shape) are given the same
+  matches without being scored. Skipped comparisons are counted as
+  templates_skipped; templates without descriptors can't be compared, so
+  they aren't counted.
+  """
+    bank = get_template_bank(shapes_dir)
+    features = CardFeatures.of(card)
+    described = [
+        (shape, shape_des)
+        for shape, shape_des in bank.items(canny=canny)
+        if shape_des is not None
+    ]
+    templates = [
+        (shape, shape_des)
+        for shape, shape_des in described
+        if not color or shape.startswith(color + "-")
+    ]
+    skipped = len(described) - len(templates)
     ret = []
+    decided = None
+
+    with instrument.span("get_best_orb_matches", canny=canny):
+        for segment in features.segments:
+            # only the card side needs describing, templates come from the bank
+            segment_des = segment.descriptors(canny=canny)
+            if segment_des is None:
+                continue
+            if decided:
+                instrument.count("templates_skipped", len(described))
+                ret.append(decided)
+                continue
+
+            possibles = []
+            for shape, shape_des in templates:
+                instrument.count("templates_matched")
+                score = descriptor_score(shape_des, segment_des)
+                if score:
+                    possibles.append((score, shape))
+            instrument.count("templates_skipped", skipped)
+
+            possibles.sort()
+            ret.append(possibles)
+            if margin is not None and len(possibles) > 1:
+                best, runner_up = possibles[0][0], possibles[1][0]
+                if best <= (1 - margin) * runner_up:
+                    decided = possibles
 
-    for segment in segments:
-        possibles = []
-        for shape in shapes:
-            shape_file = os.path.join(shapes_dir, shape)
-            score = orb_score(shape_file, segment, canny=canny)
-            if score:
-                possibles.append((score, shape))
+    return ret
 
-        possibles.sort()
-        if possibles:
-            ret.append(possibles[0])
 
+def get_best_orb_matches(
+    card, shapes_dir=ALL_SHAPES_DIR, canny=False, color=None, margin=None
+):
+    """Test card image (or its CardFeatures) against all shapes in shapes_dir,
+  and return tuples (score, label) for the best matches, one per segment.
+  See orb_segment_matches for color and margin.
+  """
+    matches = orb_segment_matches(card, shapes_dir, canny, color, margin)
+    ret = [possibles[0] for possibles in matches if possibles]
     ret.sort()
     return ret
 
 
-def pixels_mean(pixels):
-    """Input is a list of (R,G,B) tuples, output is the average (R,G,B) value."""
-    rs = [p[0] for p in pixels]
-    gs = [p[1] for p in pixels]
-    bs = [p[2] for p in pixels]
-    return (mean(rs), mean(gs), mean(bs))
-
-
-def shape_rgb(card_im):
+def orb_margin(matches, token):
+    """How much better (as a fraction) the best template match of any
+  segment is than the best match with a different value of the attribute
+  at position token in the label, or 0 if there are no matches.
+  """
+    matches = [possibles for possibles in matches if possibles]
+    if not matches:
+        return 0.0
+    possibles = min(matches, key=lambda p: p[0][0])
+    score, label = possibles[0]
+    value = label.split("-")[token]
+    others = [s for s, other in possibles if other.split("-")[token] != value]
+    if not others:
+        return 1.0
+    return 1 - float(score) / others[0]
+
+
+def shape_rgb(card):
     """Returns a tuple (R,G,B) of the average value of all non-white pixels
   after noteshrinking (which converts near-white to white).
   """
-    shrunk_im = noteshrink_card_from_im(card_im)
+    labels, palette = CardFeatures.of(card).noteshrunk()
+
+    # palette is RGB, the color averages are BGR like the rest of cv2
+    pixels = palette[:, ::-1].astype(int)[labels.flatten()]
 
     # remove white pixels
-    non_whites = []
-    for row in shrunk_im:
-        for pixel in row:
-            if sum(pixel) < 255 * 3:
-                non_whites.append(pixel)
-    return pixels_mean(non_whites)
+    non_whites = pixels[pixels.sum(axis=1) < 255 * 3]
+    if not len(non_whites):
+        return (0, 0, 0)
+    return tuple(float(c) for c in non_whites.mean(axis=0))
 
 
 def color_diff(rgb1, rgb2):
@@ -94,20 +335,24 @@ def color_diff(rgb1, rgb2):
     return sum([abs(rgb1[i] - rgb2[i]) for i in range(len(rgb1))])
 
 
-def classify_color(card_im):
+def color_distances(card):
+    """{color: distance} from the card's shape color to each color's average,
+  or None if the card's palette can't be found.
+  """
     try:
-        unclassified_rgb = shape_rgb(card_im)
+        unclassified_rgb = shape_rgb(card)
     except CannotGetPalette:
-        # handled upstream
-        return ""
-
-    # precomputed in avg_colors.py
-    color_avgs = {"red": (0, 34, 226), "green": (64, 123, 0), "purple": (89, 0, 76)}
-
-    dists = {
-        color: color_diff(color_avgs[color], unclassified_rgb) for color in color_avgs
+        return None
+    return {
+        color: color_diff(COLOR_AVGS[color], unclassified_rgb) for color in COLOR_AVGS
     }
 
+
+def classify_color(card):
+    dists = color_distances(card)
+    if dists is None:
+        # handled upstream
+        return ""
     return min(dists, key=dists.get)
 
 
@@ -116,33 +361,152 @@ def classify_number_from_shapes(shapes):
     return ["", "single", "double", "triple"][num_shapes]
 
 
-def classify_card_from_im(card_im):
-    """Classify the card's attributes, returning a label like
-  red-triple-outline-squiggle.jpg."""
-    shapes = get_best_orb_matches(card_im, canny=True)
-    shades = get_best_orb_matches(card_im)
-    color = classify_color(card_im)
-    number = classify_number_from_shapes(shapes)
+def distance_margin(dists):
+    """How much closer (as a fraction) the closest of {value: distance} is
+  than the runner-up, or 0 if there are no distances.
+  """
+    if not dists:
+        return 0.0
+    closest, runner_up = sorted(dists.values())[:2]
+    return 1 - float(closest) / (runner_up or 1)
+
+
+def attrs_label(attrs):
+    """A label like red-triple-outline-squiggle.jpg from {attr: value}."""
+    return "-".join(attrs[attr] for attr in ATTRS) + ".jpg"
 
-    if any([(not attr) for attr in (shapes, shades, color, number)]):
+
+def classify_attrs(card, engine=DEFAULT_ENGINE):
+    """Best guess of each attribute of a card image (or its CardFeatures),
+  never asking for help. Returns ({attr: value}, with "" for attributes
+  that couldn't be guessed at all, and {attr: margin}, how clearly each
+  value won, see CONFIDENT_MARGINS).
+  """
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine {}".format(engine))
+
+    with instrument.span("classify_card_from_im", engine=engine):
+        # every classifier reads from the same, once computed features
+        features = CardFeatures.of(card)
+        with instrument.span("classify_color"):
+            dists = color_distances(features)
+        attrs = {"color": min(dists, key=dists.get) if dists else ""}
+        margins = {"color": distance_margin(dists)}
+
+        if engine == "analytic":
+            stats = card_shape_stats(features)
+            attrs["number"] = classify_number(stats)
+            attrs["shade"] = classify_shade(stats)
+            attrs["shape"] = classify_shape(stats)
+            margins["shade"] = shade_margin(stats)
+            margins["shape"] = shape_margin(stats)
+            number = len(stats)
+        else:
+            # the cascade only matches the card color's templates
+            color = attrs["color"] if engine == "cascade" else None
+            margin = CASCADE_MARGIN if engine == "cascade" else None
+            shapes = orb_segment_matches(
+                features, canny=True, color=color, margin=margin
+            )
+            shades = orb_segment_matches(features, color=color, margin=margin)
+            best_shapes = sorted(p[0] for p in shapes if p)
+            best_shades = sorted(p[0] for p in shades if p)
+            attrs["number"] = classify_number_from_shapes(best_shapes)
+            # template labels end in .jpg
+            attrs["shape"] = best_shapes[0][1].split("-")[3][:-4] if best_shapes else ""
+            attrs["shade"] = best_shades[0][1].split("-")[2] if best_shades else ""
+            margins["shade"] = orb_margin(shades, 2)
+            margins["shape"] = orb_margin(shapes, 3)
+            number = len(best_shapes)
+        margins["number"] = number_margin(features, number)
+
+    return attrs, margins
+
+
+def confidence(attr, margin, engine=DEFAULT_ENGINE):
+    """margin of an attribute scaled to 0-1, where 1 is a margin at least as
+  wide as CONFIDENT_MARGINS', and MIN_CONFIDENCE half as wide.
+  """
+    return min(1.0, float(margin) / CONFIDENT_MARGINS[engine][attr])
+
+
+class CardClassification(object):
+    """Best guess of a card's attributes, and how confident each guess is."""
+
+    def __init__(self, attrs, confidence):
+        self.attrs = attrs
+        self.confidence = confidence
+
+    @property
+    def label(self):
+        """The best guess label, or "" if any attribute has no guess."""
+        if not all(self.attrs.get(attr) for attr in ATTRS):
+            return ""
+        return attrs_label(self.attrs)
+
+    @property
+    def min_confidence(self):
+        return min(self.confidence.get(attr, 0.0) for attr in ATTRS)
+
+    @property
+    def confident(self):
+        """Whether every attribute was guessed with at least MIN_CONFIDENCE."""
+        return bool(self.label and self.min_confidence >= MIN_CONFIDENCE)
+
+    def to_dict(self):
+        return {
+            "label": self.label,
+            "attrs": self.attrs,
+            "confidence": {attr: round(self.confidence[attr], 3) for attr in ATTRS},
+            "confident": self.confident,
+        }
+
+
+def classify_card_with_confidence(card_im, engine=DEFAULT_ENGINE, ask=False):
+    """Classify the card's attributes, returning a CardClassification with the
+  best guess and per attribute confidence. If ask is set, a card with an
+  attribute that can't be classified is labeled by hand, with full
+  confidence, instead.
+  """
+    attrs, margins = classify_attrs(card_im, engine=engine)
+    classification = CardClassification(
+        attrs,
+        {attr: confidence(attr, margins[attr], engine) for attr in ATTRS},
+    )
+    if classification.label or not ask:
+        return classification
+
+    instrument.count("manual_label_fallbacks")
+    # the labeling UI (and card_finder, which it imports) only loads when
+    # a card first needs it
+    from label_all_cards import manually_label_card
+
+    with _manual_label_lock, instrument.span("manually_label_card"):
         print(
             "Could not classify at least one of the attributes of this card. "
             "Please enter the attribute labels manually."
         )
-        color, number, shade, shape = manually_label_card(card_im)
-    else:
-        ret = shapes[0][1]
-        _, _, _, shape = ret.split("-")
+        tokens = manually_label_card(CardFeatures.of(card_im).im)
+
+    return CardClassification(dict(zip(ATTRS, tokens)), {attr: 1.0 for attr in ATTRS})
 
-        ret = shades[0][1]
-        _, _, shade, _ = ret.split("-")
 
-    return "-".join([color, number, shade, shape])
+def classify_card_from_im(card_im, engine=DEFAULT_ENGINE, headless=False):
+    """Classify the card's attributes, returning a label like
+  red-triple-outline-squiggle.jpg. engine is one of ENGINES, and decides
+  how number, shade and shape are found. Attributes that can't be
+  classified are asked for, unless headless is set, when "" is returned
+  instead.
+  """
+    label = classify_card_with_confidence(card_im, engine, ask=not headless).label
+    if not label:
+        instrument.count("headless_unlabeled")
+    return label
 
 
-def classify_card_from_file(card_file_to_classify):
+def classify_card_from_file(card_file_to_classify, engine=DEFAULT_ENGINE):
     card_im = cv2.imread(card_file_to_classify)
-    return classify_card_from_im(card_im)
+    return classify_card_from_im(card_im, engine=engine)
 
 
 def main():
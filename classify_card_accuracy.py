@@ -1,23 +1,62 @@
 #!/usr/bin/env python
-"""Test accuracy of card_classifier.py. To use this, generate labeled
-card images with label_all_cards.py to a directory and pass the directory
-to test_cards_in_dir()."""
+"""Test accuracy of card_classifier.py against the labeled card images in
+image-data/set-game-cards (each card's filename is its label).
 
+Cards are classified in parallel by a pool of worker processes, and every
+result is cached by the card image's content hash and the classifier
+version (the engine, the source of the classifier modules and the
+templates), so running an unchanged classifier again only classifies new
+cards. Prints per attribute scores and confusion matrices and the time
+taken per card, and optionally writes all of it as a JSON report.
+
+usage: ./classify_card_accuracy.py --engine analytic --report report.json
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
-from tqdm import tqdm
-from classify_card import classify_card_from_file
-from card_finder import find_cards, write_cards
+import time
+from collections import OrderedDict
+import cv2
+import analytic_classifier
+import card_features
+import classify_card
+import common
+import contours
+import extract_shapes
+import instrument
+import process_card
+from vendor import noteshrink
+from dataset_pack import find_image, pack_for
+from classify_card import DEFAULT_ENGINE, ENGINES, TemplateBank, classify_card_from_im
 from common import (
-    SET_GAMES_DIR,
+    ALL_SHAPES_DIR,
+    CACHE_DIR,
     SET_GAME_CARDS_DIR,
     CARD_ATTRS,
     jpgs_in_dir,
     label_to_dict,
 )
 
-GAME_NUM = 8
-GAME_FILE = os.path.join(SET_GAMES_DIR, "setgame{}.jpg".format(GAME_NUM))
-LABELED_CARDS_DIR = os.path.join(SET_GAME_CARDS_DIR, "setgame{}".format(GAME_NUM))
+GAME_NUMS = [4, 5, 7, 8, 10, 11]
+LABELED_CARDS_DIR = os.path.join(SET_GAME_CARDS_DIR, "setgame8")
+
+# cached results of each classifier version
+RESULTS_CACHE_FMT = os.path.join(CACHE_DIR, "accuracy-{}.json")
+# modules whose source decides how a card is classified
+CLASSIFIER_MODULES = [
+    analytic_classifier,
+    card_features,
+    classify_card,
+    common,
+    contours,
+    extract_shapes,
+    process_card,
+    noteshrink,
+]
+LATENCY_PERCENTILES = (50, 90, 99)
 
 
 def get_score(fle_tuples):
@@ -61,40 +100,357 @@ def get_score(fle_tuples):
     return overall_accuracy
 
 
-def test_cards_in_dir(labeled_cards_dir=LABELED_CARDS_DIR):
+def latency_stats(times):
+    """Mean, percentiles and max of seconds per card."""
+    times = sorted(times)
+    stats = OrderedDict([("mean", sum(times) / (len(times) or 1))])
+    for p in LATENCY_PERCENTILES:
+        # nearest rank
+        i = min(len(times) - 1, max(0, -(-p * len(times) // 100) - 1))
+        stats["p{}".format(p)] = times[i] if times else 0.0
+    stats["max"] = times[-1] if times else 0.0
+    return stats
+
+
+def print_timing(times):
+    """Print classification time stats, given seconds per card."""
+    print(
+        "Time per card: "
+        + ", ".join(
+            "{} {:.2f}ms".format(name, 1000 * value)
+            for name, value in latency_stats(times).items()
+        )
+    )
+
+
+def print_matching(counters):
+    """Print how many template comparisons were made, and how many the
+  cascade engine skipped.
+  """
+    matched = counters.get("templates_matched", 0)
+    skipped = counters.get("templates_skipped", 0)
+    if matched or skipped:
+        print(
+            "Template comparisons: {} made, {} skipped ({:.1f}x fewer)".format(
+                matched, skipped, float(matched + skipped) / (matched or 1)
+            )
+        )
+
+
+def label_attrs(label):
+    """label_to_dict, with every attribute empty if there is no label."""
+    if not label:
+        return {key: "" for key in CARD_ATTRS}
+    return label_to_dict(label)
+
+
+def classifier_version(engine):
+    """Identifies everything a card's label depends on besides the card."""
+    sha = hashlib.sha1(engine.encode("utf-8"))
+    for module in CLASSIFIER_MODULES:
+        with open(module.__file__, "rb") as f:
+            sha.update(f.read())
+    if engine != "analytic":
+        sha.update(TemplateBank.dir_signature(ALL_SHAPES_DIR).encode("utf-8"))
+    return sha.hexdigest()[:16]
+
+
+def file_hash(filename):
+    """Content hash of the file, from the packed dataset's index if it's in
+  one, which saves reading it.
+  """
+    pack, path = pack_for(filename)
+    if pack is not None and path in pack:
+        return pack.entry(path)["sha1"]
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_card(filename):
+    """The card image, mapped from the packed dataset if it's in one (which
+  every worker shares) rather than decoded again.
+  """
+    im = find_image(filename)
+    return cv2.imread(filename) if im is None else im
+
+
+def load_results(version):
+    """{card content hash: result} cached for the classifier version."""
+    filename = RESULTS_CACHE_FMT.format(version)
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except ValueError:
+        # partly written or corrupt, start over
+        return {}
+
+
+def save_results(version, results):
+    if not os.path.exists(CACHE_DIR):
+        os.mkdir(CACHE_DIR)
+    filename = RESULTS_CACHE_FMT.format(version)
+    # write then rename, so an interrupted run never leaves a partial file
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, "w") as f:
+        json.dump(results, f)
+    os.replace(tmp_filename, filename)
+
+
+def init_worker():
+    """Parallelism comes from the pool, so keep each worker's OpenCV from
+  starting its own threads. Counters are recorded for template comparisons.
+  """
+    cv2.setNumThreads(1)
+    instrument.enable()
+
+
+def classify_file(job):
+    """Classify one card file, for (filename, engine). Returns its label,
+  seconds taken (not counting reading the file) and template comparisons,
+  or an error instead of raising, so one bad card doesn't end a run.
+  """
+    filename, engine = job
+    card_im = read_card(filename)
+    before = instrument.counters()
+    result = {"label": "", "seconds": 0.0}
+    start = time.perf_counter()
+    try:
+        # a worker can't ask for a label, cards it can't classify are wrong
+        result["label"] = classify_card_from_im(card_im, engine=engine, headless=True)
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["seconds"] = time.perf_counter() - start
+    after = instrument.counters()
+    for key in ("templates_matched", "templates_skipped"):
+        result[key] = after.get(key, 0) - before.get(key, 0)
+    return result
+
+
+def evaluate(filenames, engine=DEFAULT_ENGINE, jobs=1, use_cache=True, quiet=False):
+    """Classify every card file, jobs at a time. Returns one result dict per
+  file, in order, with the file's "filename" and whether it was "cached".
+  """
+    version = classifier_version(engine)
+    cached = load_results(version) if use_cache else {}
+    hashes = [file_hash(filename) for filename in filenames]
+    todo = OrderedDict(
+        (h, (f, engine)) for f, h in zip(filenames, hashes) if h not in cached
+    )
+
+    if jobs > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(jobs, initializer=init_worker)
+        new = pool.imap(classify_file, todo.values())
+    else:
+        pool = None
+        instrument.enable()
+        new = (classify_file(job) for job in todo.values())
+    try:
+        if not quiet:
+            from tqdm import tqdm
+
+            new = tqdm(new, total=len(todo))
+        new_results = dict(zip(todo.keys(), new))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        else:
+            instrument.disable()
+
+    results = []
+    for filename, h in zip(filenames, hashes):
+        result = dict(cached.get(h) or new_results[h])
+        result["filename"] = filename
+        result["cached"] = h in cached
+        results.append(result)
+
+    if use_cache and new_results:
+        cached.update((h, r) for h, r in new_results.items() if "error" not in r)
+        save_results(version, cached)
+    return results
+
+
+def test_cards_in_dir(
+    labeled_cards_dir=LABELED_CARDS_DIR, engine=DEFAULT_ENGINE, jobs=1
+):
     """Feed each card in the directory to card_classifier, and compare
   the outputted label to the actual label, the card's filename
-  (card_classifier.py does not use the filename information).
+  (card_classifier.py does not use the filename information). Returns the
+  (filename, label, expected) tuples and the seconds taken to classify each
+  card, not counting reading the file.
+  """
+    filenames = sorted(jpgs_in_dir(labeled_cards_dir))
+    results = evaluate(
+        [os.path.join(labeled_cards_dir, f) for f in filenames], engine, jobs
+    )
+    fle_tuples = [
+        (f, label_attrs(r["label"]), label_to_dict(f))
+        for f, r in zip(filenames, results)
+    ]
+    return fle_tuples, [r["seconds"] for r in results]
+
+
+def confusion_matrices(fle_tuples):
+    """{attr: {expected value: {predicted value: count}}}, where the
+  predicted value "" means the attribute wasn't classified.
   """
-    fle_tuples = []
-    filenames = jpgs_in_dir(labeled_cards_dir)
+    matrices = OrderedDict()
+    for attr in sorted(CARD_ATTRS.keys()):
+        values = CARD_ATTRS[attr]
+        matrices[attr] = OrderedDict(
+            (expected, OrderedDict((got, 0) for got in values + [""]))
+            for expected in values
+        )
+    for _, label, expected in fle_tuples:
+        for attr, matrix in matrices.items():
+            row = matrix.get(expected[attr])
+            if row is not None:
+                got = label[attr] if label[attr] in row else ""
+                row[got] += 1
+    return matrices
 
-    for filename in tqdm(filenames):
-        full_path = os.path.join(labeled_cards_dir, filename)
-        label = classify_card_from_file(full_path)
-        label_dict = label_to_dict(label)
-        expected_dict = label_to_dict(filename)
-        fle_tuples.append((filename, label_dict, expected_dict))
 
-    return fle_tuples
+def print_confusion(matrices):
+    for attr, matrix in matrices.items():
+        columns = list(next(iter(matrix.values())).keys())
+        print(
+            "\n{:<12}".format(attr)
+            + "".join("{:>10}".format(got or "none") for got in columns)
+        )
+        for expected, row in matrix.items():
+            print(
+                "{:<12}".format(expected)
+                + "".join("{:>10}".format(count) for count in row.values())
+            )
+
+
+def build_report(engine, jobs, results, fle_tuples, wall_seconds):
+    """Everything main() prints, as a JSON serializable dict."""
+    attrs = sorted(CARD_ATTRS.keys())
+    total = len(fle_tuples) or 1
+    correct = {
+        attr: sum(label[attr] == expected[attr] for _, label, expected in fle_tuples)
+        for attr in attrs
+    }
+    perfect = sum(label == expected for _, label, expected in fle_tuples)
+    fresh = [r for r in results if not r["cached"]]
+    return OrderedDict(
+        [
+            ("engine", engine),
+            ("classifier_version", classifier_version(engine)),
+            ("jobs", jobs),
+            ("cards", len(results)),
+            ("cached", len(results) - len(fresh)),
+            ("errors", sum("error" in r for r in results)),
+            ("accuracy", sum(correct.values()) / float(4 * total)),
+            ("perfect", perfect / float(total)),
+            ("attribute_accuracy", {a: correct[a] / float(total) for a in attrs}),
+            ("confusion", confusion_matrices(fle_tuples)),
+            ("latency", latency_stats([r["seconds"] for r in results])),
+            ("wall_seconds", wall_seconds),
+            # of the cards actually classified in this run
+            ("cards_per_second", len(fresh) / wall_seconds if fresh else None),
+            ("templates_matched", sum(r["templates_matched"] for r in results)),
+            ("templates_skipped", sum(r["templates_skipped"] for r in results)),
+            (
+                "incorrect",
+                [
+                    os.path.relpath(r["filename"], SET_GAME_CARDS_DIR)
+                    for r, (_, label, expected) in zip(results, fle_tuples)
+                    if label != expected
+                ],
+            ),
+        ]
+    )
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Rate classify_card.py against the labeled card images."
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        default=DEFAULT_ENGINE,
+        help="Classifier engine for number, shade and shape (default %(default)s)",
+    )
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Worker processes classifying cards (default: CPU count)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="Classify every card again, ignoring and not saving cached results",
+    )
+    parser.add_argument(
+        "--report", dest="report", type=str, help="Write a JSON report to this file"
+    )
+    return parser.parse_args()
 
 
 def main():
-    all_runs = []
-    for game_num in [4, 5, 7, 8, 10, 11]:
-        print("")
-        labeled_card_dir = os.path.join(
-            SET_GAME_CARDS_DIR, "setgame{}".format(game_num)
+    args = get_args()
+
+    filenames = []
+    games = []
+    for game_num in GAME_NUMS:
+        game_dir = os.path.join(SET_GAME_CARDS_DIR, "setgame{}".format(game_num))
+        for f in sorted(jpgs_in_dir(game_dir)):
+            filenames.append(os.path.join(game_dir, f))
+            games.append(game_num)
+
+    start = time.time()
+    results = evaluate(filenames, args.engine, max(1, args.jobs), not args.no_cache)
+    wall_seconds = time.time() - start
+    fle_tuples = [
+        (
+            os.path.basename(r["filename"]),
+            label_attrs(r["label"]),
+            label_to_dict(os.path.basename(r["filename"])),
         )
-        this_run = test_cards_in_dir(labeled_card_dir)
-        print("SCORE FOR GAME {}".format(game_num))
-        get_score(this_run)
+        for r in results
+    ]
 
-        all_runs.extend(this_run)
+    for game_num in GAME_NUMS:
+        game = [t for t, g in zip(fle_tuples, games) if g == game_num]
+        perfect = sum(label == expected for _, label, expected in game)
+        print("Game {}: {} / {} perfect".format(game_num, perfect, len(game)))
+    for r in results:
+        if "error" in r:
+            print("{}: {}".format(r["filename"], r["error"]))
 
     print("-" * 20)
-    print("FULL SCORE")
-    get_score(all_runs)
+    print("FULL SCORE ({} engine)".format(args.engine))
+    get_score(fle_tuples)
+    print_confusion(confusion_matrices(fle_tuples))
+    print("")
+    print_timing([r["seconds"] for r in results])
+    print_matching(
+        {
+            key: sum(r[key] for r in results)
+            for key in ("templates_matched", "templates_skipped")
+        }
+    )
+    cached = sum(r["cached"] for r in results)
+    print(
+        "{} cards in {:.1f}s, {} from the cache".format(
+            len(results), wall_seconds, cached
+        )
+    )
+
+    if args.report:
+        report = build_report(args.engine, args.jobs, results, fle_tuples, wall_seconds)
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Wrote {}".format(args.report))
 
 
 if __name__ == "__main__":
@@ -15,6 +15,10 @@ CARD_FINDER_OUT_DIR = "finder-out"
 PROCESS_CARD_OUT_DIR = "process-out"
 SHAPES_OUT_DIR = "shapes-out"
 SOLVE_OUT = "solve-out"
+# derived data (descriptor banks etc.) that is rebuilt when its sources change
+CACHE_DIR = "cache"
+# cards a headless solve wasn't confident about, waiting to be labeled
+REVIEW_QUEUE_DIR = "review-queue"
 
 IM_DATA_DIR = "image-data"
 
@@ -42,6 +46,10 @@ CARD_ATTRS = {
 CARD_WIDTH = 450
 CARD_HEIGHT = 300
 
+# pixels around a quad read when warping it, for the interpolation to see
+# past its edges
+WARP_MARGIN = 2
+
 
 #############
 # Functions #
@@ -69,6 +77,18 @@ def write_im(im, filename, out_dir=PROCESS_CARD_OUT_DIR, print_path=False):
     return out_path
 
 
+def load_im(src, flags=cv2.IMREAD_COLOR):
+    """Return a decoded image from a filename, from encoded image bytes, or
+  from an already decoded image (returned as is, without copying).
+  Returns None if the image cannot be read.
+  """
+    if isinstance(src, np.ndarray):
+        return src
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return cv2.imdecode(np.frombuffer(src, np.uint8), flags)
+    return cv2.imread(src, flags)
+
+
 def display_im(im, imgname="image", resize=True):
     """Displays image, waits for any key press, then closes windows."""
     # shrink image if huge to fit on screen
@@ -167,6 +187,43 @@ def scale_points(points, scale):
     return points
 
 
+def quad_roi(im, quad, margin=WARP_MARGIN):
+    """The part of im within margin pixels of quad's bounding box, and the
+  (x, y) offset of its top left corner in im.
+  """
+    x, y, w, h = cv2.boundingRect(np.asarray(quad, np.float32))
+    x0, y0 = max(x - margin, 0), max(y - margin, 0)
+    x1 = min(x + w + margin, im.shape[1])
+    y1 = min(y + h + margin, im.shape[0])
+    return im[y0:y1, x0:x1], np.array([x0, y0], np.float32)
+
+
+def warp_quad(im, quad, out_w, out_h, dst=None):
+    """Warp the quadrilateral quad (clockwise from top left) of im to an
+  out_w x out_h image. Only the region around quad is read, with the
+  homography moved to match, so the cost doesn't grow with the size of im.
+  The result can be written into dst, which must be out_h x out_w.
+  """
+    roi, offset = quad_roi(im, quad)
+    corners = np.array(
+        [[0, 0], [out_w - 1, 0], [out_w - 1, out_h - 1], [0, out_h - 1]], np.float32
+    )
+    transform = cv2.getPerspectiveTransform(
+        np.asarray(quad, np.float32) - offset, corners
+    )
+    return cv2.warpPerspective(roi, transform, (out_w, out_h), dst=dst)
+
+
+def warp_quads(im, quads, out_w, out_h):
+    """warp_quad for all quads in one call, returning one array of
+  len(quads) images that each warp is written straight into.
+  """
+    out = np.empty((len(quads), out_h, out_w) + im.shape[2:], im.dtype)
+    for quad, dst in zip(quads, out):
+        warp_quad(im, quad, out_w, out_h, dst=dst)
+    return out
+
+
 def label_to_dict(label):
     """Convert a label like 'red-triple-stripes-squiggle.jpg' to
   {'color':'red', 'number':'triple'...etc}
@@ -0,0 +1,87 @@
+"""Thresholding and contour finding, shared by card_finder (card outlines)
+and extract_shapes (the shapes on a card).
+
+Each thread gets its own ContourExtractor, which keeps its grayscale and
+threshold images between calls and writes into them again when the next
+image fits, so finding the shapes of one card after another doesn't
+allocate new ones every time. The buffers only grow, up to the largest
+image the thread has seen.
+"""
+
+import threading
+import cv2
+import numpy as np
+
+# min channel cutoff for the threshold filter
+THRESH_MIN = 180
+
+
+def find_contours(thresh, mode, method=cv2.CHAIN_APPROX_SIMPLE):
+    """cv2.findContours, returning (contours, hierarchy) whichever OpenCV
+  version is installed (3.x also returns the image first).
+  """
+    return cv2.findContours(thresh, mode, method)[-2:]
+
+
+def largest_first(contours):
+    """contours sorted by area, largest first."""
+    return sorted(contours, key=cv2.contourArea, reverse=True)
+
+
+class ContourExtractor(object):
+    """Thresholds images at thresh_min and finds the contours in them.
+  Images it returns are only valid until its next call, unless asked to
+  keep them. Not thread safe, use get_extractor() for the current thread's.
+  """
+
+    def __init__(self, thresh_min=THRESH_MIN):
+        self.thresh_min = thresh_min
+        # name -> flat scratch buffer, viewed as an image of any size it fits
+        self._buffers = {}
+
+    def _buffer(self, name, shape):
+        size = shape[0] * shape[1]
+        buf = self._buffers.get(name)
+        if buf is None or buf.size < size:
+            buf = self._buffers[name] = np.empty(size, np.uint8)
+        return buf[:size].reshape(shape)
+
+    def gray(self, im):
+        """im in grayscale, as is if it already is."""
+        if im.ndim == 2:
+            return im
+        dst = self._buffer("gray", im.shape[:2])
+        return cv2.cvtColor(im, cv2.COLOR_BGR2GRAY, dst=dst)
+
+    def threshold(self, gray, invert=False, keep=False):
+        """gray thresholded so light areas are white, or dark areas if
+  invert is set. The image is newly allocated if keep is set.
+  """
+        dst = None if keep else self._buffer("thresh", gray.shape)
+        kind = cv2.THRESH_BINARY_INV if invert else cv2.THRESH_BINARY
+        _, thresh = cv2.threshold(gray, self.thresh_min, 255, kind, dst=dst)
+        return thresh
+
+    def extract(self, im, mode=cv2.RETR_EXTERNAL, invert=False, keep=False):
+        """Threshold im (BGR, or already grayscale) and find the contours in
+  it. Returns (thresh, contours, hierarchy).
+  """
+        thresh = self.threshold(self.gray(im), invert=invert, keep=keep)
+        contours, hierarchy = find_contours(thresh, mode)
+        return thresh, contours, hierarchy
+
+
+_local = threading.local()
+
+
+def get_extractor():
+    """The current thread's ContourExtractor."""
+    extractor = getattr(_local, "extractor", None)
+    if extractor is None:
+        extractor = _local.extractor = ContourExtractor()
+    return extractor
+
+
+def extract_contours(im, mode=cv2.RETR_EXTERNAL, invert=False, keep=False):
+    """ContourExtractor.extract with the current thread's extractor."""
+    return get_extractor().extract(im, mode=mode, invert=invert, keep=keep)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Pack directories of labeled images (cards, shape templates) into one
+contiguous file of decoded pixels plus a JSON index, so evaluation and
+calibration don't decode dozens of small JPEGs on every run.
+
+The pixel file is memory-mapped read-only, so every worker process that
+opens the same pack shares the operating system's one copy of it, and an
+image is a view into the map rather than a new array. Images can be looked
+up by their path in the source directory or by label (the filename, which
+several images in different games can share).
+
+A pack is rebuilt when any source image is added, removed or modified.
+
+usage: ./dataset_pack.py [labeled-cards game-cards shapes]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import cv2
+import numpy as np
+from common import (
+    ALL_CARDS_LABELED_DIR,
+    ALL_SHAPES_DIR,
+    CACHE_DIR,
+    SET_GAME_CARDS_DIR,
+)
+
+# name -> source directory of each pack
+PACK_DIRS = {
+    "labeled-cards": ALL_CARDS_LABELED_DIR,
+    "game-cards": SET_GAME_CARDS_DIR,
+    "shapes": ALL_SHAPES_DIR,
+}
+PACK_INDEX_FMT = os.path.join(CACHE_DIR, "pack-{}.json")
+# the pixels file is named after the signature too, so a process still
+# reading an old pack isn't affected when it's rebuilt
+PACK_DATA_FMT = os.path.join(CACHE_DIR, "pack-{}-{}.bin")
+
+# bump when the pack format changes, so packs written by an older version
+# get rebuilt
+PACK_VERSION = 1
+
+# packs opened by this process, keyed by name
+_packs = {}
+_packs_lock = threading.Lock()
+
+
+def source_files(src_dir):
+    """Paths of the jpgs in src_dir and its subdirectories, relative to it,
+  sorted.
+  """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, src_dir)
+        for f in sorted(filenames):
+            if f.endswith(".jpg"):
+                paths.append(os.path.normpath(os.path.join(rel_dir, f)))
+    return paths
+
+
+def source_signature(src_dir):
+    """String that changes whenever an image in src_dir is added, removed or
+  modified.
+  """
+    parts = ["v{}".format(PACK_VERSION)]
+    for path in source_files(src_dir):
+        stat = os.stat(os.path.join(src_dir, path))
+        parts.append("{}:{}:{}".format(path, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class Pack(object):
+    """Decoded images of one source directory, memory-mapped from disk.
+  Images returned are read-only views, copy one before drawing on it.
+  """
+
+    def __init__(self, src_dir, entries, data_filename, signature):
+        self.src_dir = src_dir
+        self.signature = signature
+        # [{"path", "label", "offset", "shape", "sha1"}], in path order
+        self.entries = entries
+        self._by_path = {entry["path"]: entry for entry in entries}
+        self._by_label = {}
+        for entry in entries:
+            self._by_label.setdefault(entry["label"], []).append(entry)
+        size = sum(int(np.prod(entry["shape"])) for entry in entries)
+        # np.memmap can't map an empty file
+        if size:
+            self._data = np.memmap(data_filename, np.uint8, "r", shape=(size,))
+        else:
+            self._data = np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, path):
+        return os.path.normpath(path) in self._by_path
+
+    def _image(self, entry):
+        size = int(np.prod(entry["shape"]))
+        offset = entry["offset"]
+        return self._data[offset : offset + size].reshape(entry["shape"])
+
+    def image(self, path):
+        """The image at path, relative to the source directory."""
+        return self._image(self._by_path[os.path.normpath(path)])
+
+    def entry(self, path):
+        return self._by_path[os.path.normpath(path)]
+
+    def labels(self):
+        return sorted(self._by_label)
+
+    def with_label(self, label):
+        """Every image whose filename is label."""
+        return [self._image(entry) for entry in self._by_label.get(label, [])]
+
+    def items(self):
+        """(path, image) for each image, in path order."""
+        for entry in self.entries:
+            yield entry["path"], self._image(entry)
+
+
+def build_pack(name, src_dir=None):
+    """Decode every image in the pack's source directory and write the pack
+  to CACHE_DIR, replacing the previous one.
+  """
+    src_dir = src_dir or PACK_DIRS[name]
+    signature = source_signature(src_dir)
+    data_filename = PACK_DATA_FMT.format(name, signature)
+    if not os.path.exists(CACHE_DIR):
+        os.mkdir(CACHE_DIR)
+
+    entries = []
+    offset = 0
+    # write then rename, so concurrent readers never see a partial file
+    tmp_filename = "{}.{}.tmp".format(data_filename, os.getpid())
+    with open(tmp_filename, "wb") as f:
+        for path in source_files(src_dir):
+            with open(os.path.join(src_dir, path), "rb") as jpg:
+                encoded = jpg.read()
+            im = cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_COLOR)
+            if im is None:
+                continue
+            f.write(np.ascontiguousarray(im).tobytes())
+            entries.append(
+                {
+                    "path": path,
+                    "label": os.path.basename(path),
+                    "offset": offset,
+                    "shape": list(im.shape),
+                    # the content hash of the file, for caches keyed by it
+                    "sha1": hashlib.sha1(encoded).hexdigest(),
+                }
+            )
+            offset += im.size
+    os.replace(tmp_filename, data_filename)
+
+    index = {
+        "src_dir": src_dir,
+        "signature": signature,
+        "data": os.path.basename(data_filename),
+        "entries": entries,
+    }
+    index_filename = PACK_INDEX_FMT.format(name)
+    tmp_filename = "{}.{}.tmp".format(index_filename, os.getpid())
+    with open(tmp_filename, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_filename, index_filename)
+
+    # older versions of this pack's pixels (a process that still has one
+    # mapped keeps reading it until it lets go)
+    old_data = [
+        f
+        for f in os.listdir(CACHE_DIR)
+        if f != index["data"]
+        and f.endswith(".bin")
+        and f.rsplit("-", 1)[0] == "pack-{}".format(name)
+    ]
+    for f in old_data:
+        try:
+            os.remove(os.path.join(CACHE_DIR, f))
+        except OSError:
+            pass
+    return Pack(src_dir, entries, data_filename, signature)
+
+
+def load_pack(name):
+    """The pack as last written, or None if there is none or it's unreadable."""
+    try:
+        with open(PACK_INDEX_FMT.format(name)) as f:
+            index = json.load(f)
+        data_filename = os.path.join(CACHE_DIR, index["data"])
+        return Pack(
+            index["src_dir"], index["entries"], data_filename, index["signature"]
+        )
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def get_pack(name, src_dir=None, reload=False):
+    """The pack called name (see PACK_DIRS), opened at most once per process,
+  and rebuilt first if its source images changed since it was written.
+  """
+    src_dir = src_dir or PACK_DIRS[name]
+    with _packs_lock:
+        if name in _packs and not reload:
+            return _packs[name]
+        pack = load_pack(name)
+        if (
+            pack is None
+            or pack.src_dir != src_dir
+            or pack.signature != source_signature(src_dir)
+        ):
+            pack = build_pack(name, src_dir)
+        _packs[name] = pack
+        return pack
+
+
+def pack_for(filename):
+    """(pack, path in it) of whichever pack's source directory holds
+  filename, or (None, None) if none does. The path may still not be in the
+  pack, if it isn't an image.
+  """
+    filename = os.path.normpath(filename)
+    for name, src_dir in PACK_DIRS.items():
+        if filename.startswith(os.path.normpath(src_dir) + os.sep):
+            pack = get_pack(name)
+            return pack, os.path.relpath(filename, pack.src_dir)
+    return None, None
+
+
+def find_image(filename):
+    """filename's image from whichever pack holds it, without decoding it, or
+  None if no pack does.
+  """
+    pack, path = pack_for(filename)
+    if pack is None or path not in pack:
+        return None
+    return pack.image(path)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Build (if out of date) and list packed image datasets."
+    )
+    parser.add_argument(
+        "names",
+        metavar="name",
+        type=str,
+        nargs="*",
+        help="Packs to build (default: all of {})".format(", ".join(PACK_DIRS)),
+    )
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in PACK_DIRS]
+    if unknown:
+        parser.error("unknown pack {}".format(", ".join(unknown)))
+    return args
+
+
+def main():
+    args = get_args()
+    for name in args.names or PACK_DIRS:
+        pack = get_pack(name)
+        size = sum(int(np.prod(entry["shape"])) for entry in pack.entries)
+        print(
+            "{}: {} images, {} labels, {:.1f} MB".format(
+                name, len(pack), len(pack.labels()), size / 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
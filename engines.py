@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+"""Names of the card classifier engines, kept apart from classify_card.py
+so scripts can check an --engine argument without importing OpenCV.
+"""
+
+# "orb" matches shapes against template images, "cascade" does too but
+# only against the templates of the card's color, and stops once a shape
+# clearly matches, "analytic" measures their contours (see
+# analytic_classifier.py), which is much faster
+ENGINES = ("orb", "cascade", "analytic")
+DEFAULT_ENGINE = "orb"
+# engine of solves nobody is asked to label cards in (batch mode, the
+# server, the async API). On image-data/set-games the analytic engine's
+# confident cards make 20 sets, while the few sets among the ORB engine's
+# are wrong: its margins don't tell right shade guesses from wrong ones
+HEADLESS_ENGINE = "analytic"
@@ -5,6 +5,7 @@ import os
 import sys
 import cv2
 import numpy as np
+import instrument
 from common import (
     SHAPES_OUT_DIR,
     display_im,
@@ -12,33 +13,34 @@ from common import (
     clean_make_dir,
     rectify,
     scale_points,
+    warp_quad,
 )
-
-# min channel cutoff for the threshold filter
-THRESH_MIN = 180
+from contours import extract_contours, largest_first
 
 OUT_WIDTH = 100
 OUT_HEIGHT = 200
 
 
+def find_shape_contours(card_im, keep=False):
+    """Threshold a card image (BGR, or already grayscale), returning the
+  inverted threshold image and the outer contours in it, largest first.
+  The threshold image is the thread's scratch image, valid until its next
+  use, unless keep is set.
+  """
+    # inverted, otherwise RETR_EXTERNAL makes the whole card the largest contour
+    thresh, contours, _ = extract_contours(card_im, invert=True, keep=keep)
+    return thresh, largest_first(contours)
+
+
 def extract_shapes_from_im(
-    card_im, out_w=OUT_WIDTH, out_h=OUT_HEIGHT, display_shapes=False
+    card_im, out_w=OUT_WIDTH, out_h=OUT_HEIGHT, display_shapes=False, contours=None
 ):
+    """Cut out the 1, 2, or 3 shapes on a card image. contours are the
+  card's shape contours, largest first, if already found.
+  """
     orig_im = card_im
-    im = cv2.cvtColor(orig_im, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(im, (1, 1), 1000)
-    flag, thresh = cv2.threshold(blur, THRESH_MIN, 255, cv2.THRESH_BINARY)
-
-    # invert, otherwise RETR_EXTERNAL makes the whole card the largest contour
-    thresh = cv2.bitwise_not(thresh)
-
-    # `image` is the thrown away value
-    _, contours, hierarchy = cv2.findContours(
-        thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-    )
-
-    # sort contours by largest volume
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)
+    if contours is None:
+        _, contours = find_shape_contours(orig_im)
 
     shapes = []
     for i in range(min(3, len(contours))):
@@ -52,15 +54,12 @@ def extract_shapes_from_im(
         # cv2.circle(orig_im, (point[0], point[1]), 0, (0,0,255), im.shape[0]/50)
 
         # create an image of just the shape
-        h = np.array(
-            [[0, 0], [out_w - 1, 0], [out_w - 1, out_h - 1], [0, out_h - 1]], np.float32
-        )
-        transform = cv2.getPerspectiveTransform(corners, h)
-        warp = cv2.warpPerspective(orig_im, transform, (out_w, out_h))
+        warp = warp_quad(orig_im, corners, out_w, out_h)
         if display_shapes:
             display_im(warp)
         shapes.append(warp)
 
+    instrument.count("segments_extracted", len(shapes))
     return shapes
 
 
@@ -71,8 +70,6 @@ def extract_shapes_from_file(
   on the card. Returns a list of lists of 4 points, corner coordinates of
   each bounding box.
   """
-    # a lot of this function is the same as card_finder.py's find_cards,
-    # TODO refactor for both to inherit from a common function
     orig_im = cv2.imread(card_file, 1)
     return extract_shapes_from_im(
         orig_im, out_w=out_w, out_h=out_h, display_shapes=display_shapes
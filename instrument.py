@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Record timing spans and counters through the solving pipeline, and
+export them as a Chrome trace (viewable in chrome://tracing or Perfetto)
+and as a plain text summary.
+
+Disabled by default, in which case span() returns a shared no-op context
+manager and count() returns immediately, so instrumented code pays about
+one function call per call site.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+_enabled = False
+_lock = threading.Lock()
+# Chrome trace "complete" events, see export_chrome_trace()
+_events = []
+_counters = Counter()
+_start = 0.0
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        event = {
+            "name": self.name,
+            "ph": "X",
+            "ts": (self.start - _start) * 1e6,
+            "dur": (end - self.start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if self.args:
+            event["args"] = self.args
+        with _lock:
+            _events.append(event)
+        return False
+
+
+def enable():
+    """Start recording, discarding anything recorded before."""
+    global _enabled, _start
+    with _lock:
+        del _events[:]
+        _counters.clear()
+        _start = time.perf_counter()
+        _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name, **args):
+    """Context manager timing the code it wraps as the span `name`."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def count(name, n=1):
+    """Add n to the counter `name`."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += n
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def span_stats():
+    """{span name: (calls, total seconds, max seconds)}, in first seen order."""
+    stats = OrderedDict()
+    with _lock:
+        events = list(_events)
+    for event in events:
+        calls, total, longest = stats.get(event["name"], (0, 0.0, 0.0))
+        dur = event["dur"] / 1e6
+        stats[event["name"]] = (calls + 1, total + dur, max(longest, dur))
+    return stats
+
+
+def export_chrome_trace(filename):
+    """Write the spans, and the final counter values, in the Chrome trace
+  event format.
+  """
+    with _lock:
+        events = list(_events)
+        totals = dict(_counters)
+    end_ts = max([e["ts"] + e["dur"] for e in events] or [0])
+    for name in sorted(totals):
+        events.append(
+            {
+                "name": name,
+                "ph": "C",
+                "ts": end_ts,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": {name: totals[name]},
+            }
+        )
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return filename
+
+
+def summary():
+    """Plain text table of span times and counters."""
+    lines = [
+        "{:<32} {:>7} {:>11} {:>10} {:>10}".format(
+            "span", "calls", "total ms", "mean ms", "max ms"
+        )
+    ]
+    for name, (calls, total, longest) in span_stats().items():
+        lines.append(
+            "{:<32} {:>7} {:>11.1f} {:>10.2f} {:>10.2f}".format(
+                name, calls, total * 1e3, total * 1e3 / calls, longest * 1e3
+            )
+        )
+    totals = counters()
+    if totals:
+        lines.append("")
+        lines.append("{:<32} {:>7}".format("counter", "value"))
+        for name in sorted(totals):
+            lines.append("{:<32} {:>7}".format(name, totals[name]))
+    return "\n".join(lines)
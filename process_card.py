@@ -2,12 +2,14 @@
 """Process a card image to make it easier to match an unlabeled card to
 the correct labeled card."""
 
+import math
 import os
 import sys
 import cv2
 import numpy as np
 from common import PROCESS_CARD_OUT_DIR, write_im, display_im, shrink
 
+import instrument
 from vendor import noteshrink
 
 PROCESSED_CARD_FILENAME = "processed.jpg"
@@ -32,38 +34,146 @@ def blur_card(card_filename):
     return filename
 
 
+# options used to noteshrink every card, see card_noteshrink_options()
+_card_options = None
+
+
+def card_noteshrink_options():
+    """noteshrink options for cards: a 2 color palette (the background and
+  the color of the shapes), with the background made white. Built once and
+  shared, so it must not be modified by callers.
+  """
+    global _card_options
+    if _card_options is None:
+        # parse an empty list so we never pick up this process's sys.argv
+        options = noteshrink.get_argument_parser().parse_args([])
+        options.num_colors = 2
+        options.white_bg = True
+        options.quiet = True
+        _card_options = options
+    return _card_options
+
+
+def sample_card_pixels(img, fraction):
+    """About fraction of img's pixels, as an N x 3 array: every nth pixel in
+  row-major order, with n picked so it doesn't divide the row length (so
+  the samples don't all fall in the same few columns). Unlike
+  noteshrink.sample_pixels, this doesn't shuffle every pixel index, and
+  gives the same samples every time.
+  """
+    width = img.shape[1]
+    step = max(1, int(round(1 / fraction)))
+    while step > 1 and math.gcd(step, width) != 1:
+        step += 1
+    return img.reshape((-1, 3))[step // 2 :: step]
+
+
+def card_bg_color(samples):
+    """The most common color of samples at 6 bits per channel, the same as
+  noteshrink.get_bg_color.
+  """
+    quantized = (samples >> 2).astype(np.int32)
+    packed = quantized[:, 0] << 12 | quantized[:, 1] << 6 | quantized[:, 2]
+    values, counts = np.unique(packed, return_counts=True)
+    mode = int(values[counts.argmax()])
+    return np.array([mode >> 12, (mode >> 6) & 63, mode & 63]) * 4 + 2
+
+
+def card_sv(pixels):
+    """Saturation and value of an array of RGB pixels, as float32 arrays,
+  exactly as noteshrink.rgb_to_sv computes them, but from the channels
+  rather than reductions over the last axis.
+  """
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    cmax = np.maximum(np.maximum(r, g), b).astype(np.float32)
+    cmin = np.minimum(np.minimum(r, g), b).astype(np.float32)
+    saturation = np.zeros_like(cmax)
+    np.divide(cmax - cmin, cmax, out=saturation, where=cmax > 0)
+    return saturation, cmax / 255.0
+
+
+def card_fg_mask(bg_color, pixels, options):
+    """Which pixels differ enough from bg_color in saturation or value to be
+  foreground, see noteshrink.get_fg_mask.
+  """
+    s_bg, v_bg = noteshrink.rgb_to_sv(bg_color)
+    s, v = card_sv(pixels)
+    return (np.abs(v_bg - v) >= options.value_threshold) | (
+        np.abs(s_bg - s) >= options.sat_threshold
+    )
+
+
+def card_palette(samples, options):
+    """The background color and the mean foreground color of samples, which
+  is what noteshrink.get_palette's k-means comes to with a 2 color palette
+  (one cluster), without running it.
+  Raises noteshrink.CannotGetPalette if no foreground pixels were sampled.
+  """
+    bg_color = card_bg_color(samples)
+    fg_mask = card_fg_mask(bg_color, samples, options)
+    if not fg_mask.any():
+        raise noteshrink.CannotGetPalette("Unable to detect any foreground pixels")
+    fg_color = samples[fg_mask].astype(np.float32).mean(axis=0)
+    return np.vstack((bg_color, fg_color)).astype(np.uint8)
+
+
+def apply_card_palette(img, palette, options):
+    """Label each pixel of img 1 if it is foreground and closer to the
+  foreground color than the background's, 0 otherwise, as
+  noteshrink.apply_palette does with a 2 color palette.
+  """
+    fg_mask = card_fg_mask(palette[0], img, options)
+    bg, fg = palette.astype(np.int32)
+    # |p - fg|^2 < |p - bg|^2 is 2 p.(fg - bg) > |fg|^2 - |bg|^2, exactly, in
+    # integers; ties go to the background, like vq
+    projection = img.reshape((-1, 3)).astype(np.int32).dot(fg - bg)
+    closer = 2 * projection.reshape(img.shape[:2]) > fg.dot(fg) - bg.dot(bg)
+    return (fg_mask & closer).astype(np.uint8)
+
+
+def noteshrink_card_labels(card_im, shrink_max_dim=120):
+    """Noteshrink a BGR card image entirely in memory. Returns (labels, palette):
+  the palette index of each pixel of the shrunk card, and the finalized RGB
+  palette with the (white) background first.
+  Raises noteshrink.CannotGetPalette if no foreground pixels were found.
+  """
+    with instrument.span("noteshrink_card_labels"):
+        options = card_noteshrink_options()
+        # shrinking before swapping channels gives the same image, for less
+        img = cv2.cvtColor(shrink(card_im, max_dim=shrink_max_dim), cv2.COLOR_BGR2RGB)
+
+        samples = sample_card_pixels(img, options.sample_fraction)
+        palette = card_palette(samples, options)
+        labels = apply_card_palette(img, palette, options)
+
+        return labels, noteshrink.finalize_palette(palette, options)
+
+
 def noteshrink_card_from_im(card_im):
-    # TODO make this not have to write to file
-    tmp_file = write_im(card_im, "tmp.jpg")
-    noteshrunk_file = noteshrink_card_from_file(tmp_file)
-    noteshrunk_im = cv2.imread(noteshrunk_file, 1)
-    os.remove(noteshrunk_file)
-    return noteshrunk_im
+    """Noteshrink a BGR card image, returning the shrunk BGR image."""
+    labels, palette = noteshrink_card_labels(card_im)
+    # palette is RGB, flip to BGR like every other cv2 image
+    return np.ascontiguousarray(palette[labels][:, :, ::-1])
 
 
 def noteshrink_card_from_file(card_filename, shrink_max_dim=120):
-    img, dpi = noteshrink.load(card_filename)
-    img = shrink(img, max_dim=shrink_max_dim)
-    options = noteshrink.get_argument_parser(
-        # hack to give a required argument from outside sys.argv
-        filenames=[card_filename]
-    ).parse_args()
-    options.num_colors = 2
-    options.white_bg = True
-    options.quiet = True
+    with instrument.span("noteshrink_card_from_file"):
+        img, dpi = noteshrink.load(card_filename)
+        if img is None:
+            return
 
-    if img is None:
-        return
+        img = shrink(img, max_dim=shrink_max_dim)
+        options = card_noteshrink_options()
 
-    output_filename = "%s.out.png" % (card_filename)
+        output_filename = "%s.out.png" % (card_filename)
 
-    samples = noteshrink.sample_pixels(img, options)
-    palette = noteshrink.get_palette(samples, options)
+        samples = noteshrink.sample_pixels(img, options)
+        palette = noteshrink.get_palette(samples, options)
 
-    labels = noteshrink.apply_palette(img, palette, options)
+        labels = noteshrink.apply_palette(img, palette, options)
 
-    noteshrink.save(output_filename, labels, palette, dpi, options)
-    return output_filename
+        noteshrink.save(output_filename, labels, palette, dpi, options)
+        return output_filename
 
 
 def process_card(card_filename):
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Cards a headless solve wasn't confident about, saved for someone to
+label later instead of stopping the solve to ask.
+
+Each card is a JPEG in the queue directory, named by a hash of the image so
+the same card queued twice is stored once, next to a JSON file with the
+classifier's best guess, its per attribute confidence, the image the card
+came from and, once reviewed, the label given to it.
+
+usage: ./review_queue.py [--dir review-queue] [--list]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import cv2
+from common import REVIEW_QUEUE_DIR
+
+
+class ReviewQueue(object):
+    """Queue of card images waiting to be labeled, stored in path. Entries
+  are written to a temporary file and renamed into place, so any number of
+  threads or processes can add to the same queue.
+  """
+
+    def __init__(self, path=REVIEW_QUEUE_DIR):
+        self.path = path
+
+    def _filename(self, card_id, ext):
+        return os.path.join(self.path, "{}.{}".format(card_id, ext))
+
+    def _write(self, filename, data):
+        # unique to the thread, so concurrent writes of a card don't collide
+        tmp_filename = "{}.{}.{}.tmp".format(
+            filename, os.getpid(), threading.get_ident()
+        )
+        with open(tmp_filename, "wb") as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+
+    def _write_entry(self, entry):
+        data = json.dumps(entry, indent=2, sort_keys=True).encode("utf-8")
+        self._write(self._filename(entry["id"], "json"), data)
+
+    def add(self, card_im, classification, source=None):
+        """Queue card_im with its classify_card.CardClassification. source is
+    the game image it was found in, if known. Returns the card's id.
+    A card that is already queued keeps its entry, and its label if it has
+    been reviewed.
+    """
+        _, jpg = cv2.imencode(".jpg", card_im)
+        jpg = jpg.tobytes()
+        card_id = hashlib.sha1(jpg).hexdigest()[:16]
+        if os.path.exists(self._filename(card_id, "json")):
+            return card_id
+
+        os.makedirs(self.path, exist_ok=True)
+        self._write(self._filename(card_id, "jpg"), jpg)
+        entry = classification.to_dict()
+        entry.update(
+            {"id": card_id, "source": source, "queued": time.time(), "reviewed": None}
+        )
+        self._write_entry(entry)
+        return card_id
+
+    def get(self, card_id):
+        with open(self._filename(card_id, "json")) as f:
+            return json.load(f)
+
+    def image(self, card_id):
+        return cv2.imread(self._filename(card_id, "jpg"))
+
+    def entries(self):
+        """Every queued card's entry, oldest first."""
+        if not os.path.isdir(self.path):
+            return []
+        entries = [
+            self.get(name[: -len(".json")])
+            for name in os.listdir(self.path)
+            if name.endswith(".json")
+        ]
+        return sorted(entries, key=lambda entry: entry["queued"])
+
+    def pending(self):
+        """Entries of the cards nobody has labeled yet."""
+        return [entry for entry in self.entries() if not entry["reviewed"]]
+
+    def label(self, card_id, label):
+        """Record the reviewed label of a queued card."""
+        entry = self.get(card_id)
+        entry["reviewed"] = label
+        self._write_entry(entry)
+        return entry
+
+    def __len__(self):
+        return len(self.pending())
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Label the cards headless solves weren't confident about."
+    )
+    parser.add_argument(
+        "--dir",
+        dest="dir",
+        type=str,
+        default=REVIEW_QUEUE_DIR,
+        help="Review queue directory (default %(default)s)",
+    )
+    parser.add_argument(
+        "--list",
+        dest="list",
+        action="store_true",
+        help="Print the pending cards as JSON lines instead of labeling them",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    queue = ReviewQueue(args.dir)
+    pending = queue.pending()
+    if args.list:
+        for entry in pending:
+            print(json.dumps(entry, sort_keys=True))
+        return
+
+    # the labeling UI only loads when there is something to label
+    from label_all_cards import manually_label_card
+
+    for i, entry in enumerate(pending):
+        print(
+            "Card {} of {} from {}, best guess {} (confidence {})".format(
+                i + 1,
+                len(pending),
+                entry["source"],
+                entry["label"] or "none",
+                entry["confidence"],
+            )
+        )
+        tokens = manually_label_card(queue.image(entry["id"]))
+        queue.label(entry["id"], "-".join(tokens) + ".jpg")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+"""Local HTTP service that solves SET game images.
+
+POST an encoded game image as the request body to /solve (add ?annotate=1
+to also get the image with the sets drawn on it, as base64 JPEG), and get
+the cards and sets back as JSON. GET /health returns queue statistics.
+
+Templates are loaded once by a fixed pool of warm worker processes. Cards
+from concurrent requests are gathered into micro-batches before being sent
+to the workers, and requests beyond --max-pending get a 503 response with
+a Retry-After header instead of queueing without bound. A worker that dies
+fails the requests it was classifying cards for, and the pool is started
+again for the next ones; requests whose cards aren't classified within
+--timeout seconds get a 503 too.
+
+Cards are classified headless: nobody is ever asked for a label, sets are
+found among the cards classified confidently (by the --engine classifier,
+analytic by default), and the others are saved to --review-queue, if given.
+"""
+
+import argparse
+import base64
+import functools
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import cv2
+from card_finder import find_cards
+from classify_card import (
+    ENGINES,
+    HEADLESS_ENGINE,
+    classify_card_with_confidence,
+    get_template_bank,
+)
+from common import load_im
+from review_queue import ReviewQueue
+from SetGame import Card, SetGame
+
+DEFAULT_PORT = 8000
+# most cards sent to the workers at once
+DEFAULT_MAX_BATCH = 32
+# how long to wait for more cards once a batch has started, in seconds
+DEFAULT_BATCH_WAIT = 0.01
+# requests being solved at once before new ones are turned away
+DEFAULT_MAX_PENDING = 8
+# longest a request waits for its cards to be classified, in seconds
+DEFAULT_TIMEOUT = 30
+RETRY_AFTER = 1
+
+
+class Overloaded(Exception):
+    """Too many requests are already being solved."""
+
+
+class BadImage(Exception):
+    """The request body is not an image OpenCV can decode."""
+
+
+class TimedOut(Exception):
+    """The request's cards weren't classified in time."""
+
+
+def warm_worker():
+    """Load everything classification needs before the first request."""
+    cv2.setNumThreads(1)
+    get_template_bank()
+
+
+def classify_cards(card_ims, engine=HEADLESS_ENGINE):
+    return [classify_card_with_confidence(im, engine=engine) for im in card_ims]
+
+
+class CardBatcher(object):
+    """Collects cards from all requests into batches and classifies each
+  batch on a pool of worker processes, split evenly between them.
+  With workers=0, cards are classified in the batcher's own thread.
+  """
+
+    def __init__(
+        self,
+        workers,
+        max_batch=DEFAULT_MAX_BATCH,
+        batch_wait=DEFAULT_BATCH_WAIT,
+        engine=HEADLESS_ENGINE,
+    ):
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine {}".format(engine))
+        self.workers = workers
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.classify_cards = functools.partial(classify_cards, engine=engine)
+        self.batches = 0
+        self.cards = 0
+        # times the pool was started again after a worker died
+        self.restarts = 0
+        # (card image, future) pairs
+        self._queue = queue.Queue()
+        self._executor = None
+        if workers:
+            self._start_pool()
+            # start the workers now rather than on the first request
+            for future in [self._executor.submit(warm_worker) for _ in range(workers)]:
+                future.result()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def classify(self, card_ims):
+        """Futures for the CardClassifications of card_ims."""
+        futures = []
+        for im in card_ims:
+            future = Future()
+            self._queue.put((im, future))
+            futures.append(future)
+        return futures
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _start_pool(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+        self._executor = ProcessPoolExecutor(self.workers, initializer=warm_worker)
+
+    def _submit(self, chunk):
+        """Send chunk to the workers, starting a new pool first if a worker
+    died and broke the current one.
+    """
+        ims = [im for im, _ in chunk]
+        try:
+            result = self._executor.submit(self.classify_cards, ims)
+        except BrokenProcessPool:
+            self.restarts += 1
+            self._start_pool()
+            result = self._executor.submit(self.classify_cards, ims)
+        result.add_done_callback(self._chunk_done(chunk))
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self.batches += 1
+            self.cards += len(batch)
+            if not self._executor:
+                self._resolve(batch, self.classify_cards)
+                continue
+            # one chunk per worker, so IPC is paid per chunk rather than card
+            size = -(-len(batch) // self.workers)
+            for i in range(0, len(batch), size):
+                chunk = batch[i : i + size]
+                # fail the chunk rather than the thread, which later batches
+                # still need
+                try:
+                    self._submit(chunk)
+                except Exception as e:
+                    for _, future in chunk:
+                        future.set_exception(e)
+
+    @staticmethod
+    def _chunk_done(chunk):
+        def callback(result):
+            CardBatcher._resolve(chunk, lambda ims: result.result())
+
+        return callback
+
+    @staticmethod
+    def _resolve(chunk, classify):
+        try:
+            labels = classify([im for im, _ in chunk])
+        except Exception as e:
+            for _, future in chunk:
+                future.set_exception(e)
+            return
+        for (_, future), label in zip(chunk, labels):
+            future.set_result(label)
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+
+class SolveService(object):
+    """Solves images, sharing one CardBatcher between concurrent requests."""
+
+    def __init__(
+        self,
+        batcher,
+        max_pending=DEFAULT_MAX_PENDING,
+        review_queue=None,
+        timeout=DEFAULT_TIMEOUT,
+    ):
+        self.batcher = batcher
+        self.max_pending = max_pending
+        self.timeout = timeout
+        # review_queue.ReviewQueue for the cards that weren't confident
+        self.review_queue = review_queue
+        self.solved = 0
+        self.rejected = 0
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def solve(self, encoded, annotate=False):
+        """Solve an encoded game image, returning a JSON serializable dict.
+    Raises Overloaded if max_pending requests are already being solved,
+    BadImage if the image cannot be decoded, and TimedOut if its cards
+    aren't classified within timeout seconds.
+    """
+        if not self._pending.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded()
+        try:
+            return self._solve(encoded, annotate)
+        finally:
+            self._pending.release()
+
+    def _solve(self, encoded, annotate):
+        timing = {}
+        start = time.time()
+        im = load_im(encoded)
+        if im is None:
+            raise BadImage("Cannot decode image")
+        timing["decode"] = time.time() - start
+
+        stage_start = time.time()
+        game = SetGame(im)
+        cards = find_cards(im, with_corners=True)
+        game.cards = [Card(card_im, corners) for card_im, corners in cards]
+        timing["find_cards"] = time.time() - stage_start
+
+        stage_start = time.time()
+        futures = self.batcher.classify([card.im for card in game.cards])
+        deadline = stage_start + self.timeout
+        for card, future in zip(game.cards, futures):
+            try:
+                classification = future.result(max(0, deadline - time.time()))
+            except FutureTimeout:
+                raise TimedOut("Cards not classified in {}s".format(self.timeout))
+            card.classified(classification)
+            if not card.confident and self.review_queue is not None:
+                self.review_queue.add(card.im, classification)
+        timing["classify"] = time.time() - stage_start
+
+        game.find_sets()
+        ret = {
+            "cards": [card.to_dict() for card in game.cards],
+            "sets": [[game.cards.index(card) for card in s] for s in game.sets],
+        }
+        if annotate:
+            game.draw_sets()
+            _, jpg = cv2.imencode(".jpg", game.im)
+            ret["image"] = base64.b64encode(jpg.tobytes()).decode("ascii")
+        timing["total"] = time.time() - start
+        ret["timing"] = timing
+
+        with self._lock:
+            self.solved += 1
+        return ret
+
+    def health(self):
+        return {
+            "solved": self.solved,
+            "rejected": self.rejected,
+            "max_pending": self.max_pending,
+            "queued_cards": self.batcher.queued(),
+            "batches": self.batcher.batches,
+            "batched_cards": self.batcher.cards,
+            "pool_restarts": self.batcher.restarts,
+        }
+
+
+class SolveHandler(BaseHTTPRequestHandler):
+    # set by make_server()
+    service = None
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self.send_json(200, self.service.health())
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/solve":
+            self.send_json(404, {"error": "Not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            self.send_json(400, {"error": "Send the image as the request body"})
+            return
+        encoded = self.rfile.read(length)
+        annotate = parse_qs(url.query).get("annotate", ["0"])[0] not in ("0", "")
+
+        try:
+            result = self.service.solve(encoded, annotate=annotate)
+        except Overloaded:
+            self.send_json(
+                503,
+                {"error": "Too many requests, retry later"},
+                headers=[("Retry-After", str(RETRY_AFTER))],
+            )
+        except TimedOut as e:
+            self.send_json(
+                503, {"error": str(e)}, headers=[("Retry-After", str(RETRY_AFTER))]
+            )
+        except BadImage as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            self.send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+        else:
+            self.send_json(200, result)
+
+    def log_message(self, fmt, *args):
+        # keep the console quiet under load
+        pass
+
+
+def make_server(service, host="127.0.0.1", port=DEFAULT_PORT):
+    handler = type("Handler", (SolveHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Serve SET solving over HTTP.")
+    parser.add_argument("--host", dest="host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", dest="port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Card classification worker processes (default: CPU count)",
+    )
+    parser.add_argument(
+        "--max-batch",
+        dest="max_batch",
+        type=int,
+        default=DEFAULT_MAX_BATCH,
+        help="Most cards classified in one batch (default %(default)s)",
+    )
+    parser.add_argument(
+        "--batch-wait",
+        dest="batch_wait",
+        type=float,
+        default=DEFAULT_BATCH_WAIT,
+        help="Seconds to wait for more cards to batch (default %(default)s)",
+    )
+    parser.add_argument(
+        "--max-pending",
+        dest="max_pending",
+        type=int,
+        default=DEFAULT_MAX_PENDING,
+        help="Requests solved at once before answering 503 (default %(default)s)",
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="Seconds a request waits for its cards to be classified before "
+        "answering 503 (default %(default)s)",
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        default=HEADLESS_ENGINE,
+        help="Classifier engine for number, shade and shape (default %(default)s)",
+    )
+    parser.add_argument(
+        "--review-queue",
+        dest="review_queue",
+        type=str,
+        help="Save the cards that weren't classified confidently to this "
+        "directory, to label with review_queue.py",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+
+    batcher = CardBatcher(args.workers, args.max_batch, args.batch_wait, args.engine)
+    review_queue = ReviewQueue(args.review_queue) if args.review_queue else None
+    service = SolveService(batcher, args.max_pending, review_queue, args.timeout)
+    server = make_server(service, args.host, args.port)
+    print("Serving on http://{}:{}/solve".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.shutdown()
+
+
+if __name__ == "__main__":
+    main()
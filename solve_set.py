@@ -1,18 +1,42 @@
 #!/usr/bin/env python
 """Solve SET from a game image. Prints the sets found, and optionally
 writes and/or displays the game image with the sets indicated.
+
+In batch mode, solves many images (files, directories or glob patterns)
+across a pool of worker processes and writes one JSON line per image.
+Batch mode is always headless: cards are never labeled by hand, sets are
+found among the cards classified confidently, and the others can be saved
+to a review queue (see review_queue.py) to be labeled later.
 """
 
 import argparse
+import functools
+import glob
+import json
+import multiprocessing
+import os
 import sys
-from SetGame import SetGame
-from common import game_img_filename
+import time
+import instrument
+from engines import DEFAULT_ENGINE, ENGINES, HEADLESS_ENGINE
+
+# the pipeline (and OpenCV with it) is imported by the functions that use
+# it, so --help and argument errors answer straight away
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# card cache of this process, see get_cache()
+_cache = None
 
 
 def get_args():
     parser = argparse.ArgumentParser(description="Solve SET from a game image.")
     parser.add_argument(
-        "filename", metavar="filename", type=str, nargs="?", help="Game image filename"
+        "filenames",
+        metavar="filename",
+        type=str,
+        nargs="*",
+        help="Game image filename (in batch mode: files, directories or globs)",
     )
     parser.add_argument(
         "--game",
@@ -32,22 +56,247 @@ def get_args():
         action="store_true",
         help="Display the solved image with cv2.display()",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--batch",
+        dest="batch",
+        action="store_true",
+        help="Solve every given image and write one JSON line per image",
+    )
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of worker processes in batch mode (default: CPU count)",
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        type=int,
+        help="Number of threads classifying one image's cards concurrently "
+        "(default: CPU count, or 1 in batch mode)",
+    )
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        type=str,
+        help="Record where time is spent, write it to this file as a Chrome "
+        "trace and print a summary (batch mode needs --jobs 1)",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        type=str,
+        help="Reuse card labels from, and save new ones to, this cache file",
+    )
+    parser.add_argument(
+        "--headless",
+        dest="headless",
+        action="store_true",
+        help="Never ask for card labels, only find sets among the cards "
+        "classified confidently (always on in batch mode)",
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=ENGINES,
+        help="Classifier engine for number, shade and shape (default: {} in "
+        "batch or headless mode, {} otherwise)".format(HEADLESS_ENGINE, DEFAULT_ENGINE),
+    )
+    parser.add_argument(
+        "--review-queue",
+        dest="review_queue",
+        type=str,
+        help="Save the cards a headless solve isn't confident about to this "
+        "directory, to label with review_queue.py",
+    )
+    parser.add_argument(
+        "--out",
+        dest="out",
+        type=str,
+        help="Write batch results to this file instead of stdout",
+    )
+    args = parser.parse_args()
+    if len(args.filenames) > 1 and not args.batch:
+        parser.error("only one filename can be solved without --batch")
+    return args
 
 
-def main():
-    args = get_args()
+def expand_filenames(paths):
+    """Expand directories and glob patterns into a sorted list of image files."""
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+        else:
+            # expand patterns here too, in case the shell did not
+            matches = sorted(glob.glob(path)) or [path]
+        filenames.extend([f for f in matches if f.lower().endswith(IMAGE_EXTENSIONS)])
+    return filenames
+
+
+def get_cache(path):
+    """The card cache at path, opened once per process."""
+    global _cache
+    if path and _cache is None:
+        from card_cache import CardCache
+
+        _cache = CardCache(path)
+    return _cache
+
+
+def get_review_queue(path):
+    if not path:
+        return None
+    from review_queue import ReviewQueue
+
+    return ReviewQueue(path)
+
+
+def solve_file(
+    filename, threads=1, cache_path=None, review_queue_path=None, engine=None
+):
+    """Solve one game image headless and return a JSON serializable record
+  of the cards (with their confidence), sets and time spent. A failure is
+  recorded in the "error" field instead of being raised, so one bad image
+  does not end a batch. engine defaults to engines.HEADLESS_ENGINE.
+  """
+    from SetGame import SetGame
+
+    record = {"filename": filename, "timing": {}}
+    start = time.time()
+    try:
+        game = SetGame(filename, cache=get_cache(cache_path))
+        if game.im is None:
+            raise IOError("Cannot read image {}".format(filename))
+        record["timing"]["decode"] = time.time() - start
+
+        stage_start = time.time()
+        game.get_cards(
+            show_tqdm=False,
+            workers=threads,
+            headless=True,
+            review_queue=get_review_queue(review_queue_path),
+            engine=engine,
+        )
+        record["timing"]["cards"] = time.time() - stage_start
+
+        stage_start = time.time()
+        game.find_sets()
+        record["timing"]["sets"] = time.time() - stage_start
+
+        record["cards"] = [card.to_dict() for card in game.cards]
+        # sets refer to cards by their index in "cards"
+        record["sets"] = [[game.cards.index(card) for card in s] for s in game.sets]
+    except Exception as e:
+        record["error"] = "{}: {}".format(type(e).__name__, e)
+    record["timing"]["total"] = time.time() - start
+    return record
+
+
+def init_worker():
+    """Parallelism comes from the pool, so keep each worker's OpenCV from
+  starting its own threads and oversubscribing the CPUs.
+  """
+    import cv2
+
+    cv2.setNumThreads(1)
+
+
+def solve_batch(
+    filenames,
+    jobs,
+    out,
+    threads=1,
+    cache_path=None,
+    review_queue_path=None,
+    engine=None,
+):
+    """Solve all filenames with a pool of jobs processes, writing each record
+  to out as one JSON line, in input order. Returns the number of errors.
+  """
+    errors = 0
+    solve = functools.partial(
+        solve_file,
+        threads=threads,
+        cache_path=cache_path,
+        review_queue_path=review_queue_path,
+        engine=engine,
+    )
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, initializer=init_worker)
+        records = pool.imap(solve, filenames)
+    else:
+        pool = None
+        records = (solve(filename) for filename in filenames)
+
+    try:
+        for record in records:
+            if "error" in record:
+                errors += 1
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return errors
+
+
+def batch_main(args):
+    filenames = expand_filenames(args.filenames)
+    if not filenames:
+        print("Error: no images found in {}".format(" ".join(args.filenames)))
+        sys.exit(1)
+
+    start = time.time()
+    out = open(args.out, "w") if args.out else sys.stdout
+    try:
+        errors = solve_batch(
+            filenames,
+            max(1, args.jobs),
+            out,
+            args.threads or 1,
+            args.cache,
+            args.review_queue,
+            args.engine,
+        )
+    finally:
+        if args.out:
+            out.close()
+
+    sys.stderr.write(
+        "Solved {} images ({} errors) in {:.1f}s\n".format(
+            len(filenames), errors, time.time() - start
+        )
+    )
+
+
+def solve_main(args):
+    from common import game_img_filename
+    from SetGame import SetGame
 
     if args.game_num:
         filename = game_img_filename(args.game_num)
-    elif args.filename:
-        filename = args.filename
+    elif args.filenames:
+        filename = args.filenames[0]
     else:
         print("Error: must pass either a filename or --game GAME_NUM")
         sys.exit(1)
 
-    game = SetGame(filename)
-    game.solve()
+    cache = get_cache(args.cache)
+    game = SetGame(filename, cache=cache)
+    review_queue = get_review_queue(args.review_queue)
+    game.solve(
+        workers=args.threads or multiprocessing.cpu_count(),
+        headless=args.headless,
+        review_queue=review_queue,
+        engine=args.engine,
+    )
+    if review_queue is not None and len(review_queue):
+        sys.stderr.write("Cards to review: {}\n".format(len(review_queue)))
+    if cache is not None:
+        sys.stderr.write("Card cache: {}\n".format(cache.stats()))
     game.print_sets()
     game.draw_sets()
 
@@ -57,5 +306,25 @@ def main():
         game.display()
 
 
+def main():
+    args = get_args()
+
+    if args.trace:
+        if args.batch and args.jobs > 1:
+            print("Error: --trace records one process, use it with --jobs 1")
+            sys.exit(1)
+        instrument.enable()
+
+    if args.batch:
+        batch_main(args)
+    else:
+        solve_main(args)
+
+    if args.trace:
+        instrument.export_chrome_trace(args.trace)
+        sys.stderr.write(instrument.summary() + "\n")
+        sys.stderr.write("Wrote trace to {}\n".format(args.trace))
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""Solve SET continuously from a video file, camera or image sequence.
+Cards are tracked between frames so only new or changed cards are
+classified again, frames where nothing moved are skipped entirely, and an
+update (one JSON line) is printed only when the board changes.
+"""
+
+import argparse
+import functools
+import glob
+import json
+import os
+import sys
+import cv2
+import numpy as np
+import instrument
+from card_finder import find_cards
+from classify_card import classify_card_from_im
+from common import CARD_WIDTH, CARD_HEIGHT, shrink
+from SetGame import Card, SetGame
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# max dimension of the downscaled frame used to tell if anything moved
+STILL_FRAME_DIM = 160
+# mean absolute gray level difference below which a frame counts as unchanged
+STILL_FRAME_DIFF = 2.0
+# size of the card thumbnails compared to decide if a card changed
+THUMB_SIZE = (CARD_WIDTH // 10, CARD_HEIGHT // 10)
+# mean absolute gray level difference above which a card is reclassified
+CARD_CHANGE_DIFF = 20.0
+# a detection matches a track if their centers are closer than this
+# fraction of the card's diagonal
+MAX_MATCH_DIST = 0.5
+# frames a card can go undetected before it is dropped from the board
+MAX_MISSES = 3
+
+
+def iter_frames(source):
+    """Yield frames from a directory of images, a glob pattern, a camera
+  index, or anything cv2.VideoCapture can open (video files, printf style
+  image sequences like frame%04d.jpg).
+  """
+    if os.path.isdir(source) or any(c in source for c in "*?["):
+        if os.path.isdir(source):
+            filenames = [os.path.join(source, f) for f in sorted(os.listdir(source))]
+        else:
+            filenames = sorted(glob.glob(source))
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                frame = cv2.imread(filename, 1)
+                if frame is not None:
+                    yield frame
+        return
+
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def thumbnail(card_im):
+    gray = cv2.cvtColor(card_im, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def mean_abs_diff(im1, im2):
+    return float(cv2.absdiff(im1, im2).mean())
+
+
+class Track(object):
+    """One physical card followed across frames."""
+
+    def __init__(self, track_id, card_im, corners):
+        self.id = track_id
+        self.card = Card(card_im, corners)
+        self.thumb = thumbnail(card_im)
+        self.misses = 0
+
+    @property
+    def center(self):
+        return self.card.corners.mean(axis=0)
+
+    @property
+    def diagonal(self):
+        return float(np.linalg.norm(self.card.corners[2] - self.card.corners[0]))
+
+
+class StreamSolver(object):
+    """Keeps the board state between frames. Feed frames to process(), which
+  returns an update dict when the board changed and None otherwise. Cards
+  are classified headless by default, so a card that can't be classified
+  gets an empty label instead of stopping the stream to ask for one.
+  """
+
+    def __init__(
+        self, classify=functools.partial(classify_card_from_im, headless=True)
+    ):
+        self.classify = classify
+        self.tracks = []
+        self.next_id = 0
+        self.last_still = None
+        self.board = None
+        # game holding the current board, once there is one
+        self.game = None
+        self.frame_num = -1
+        # number of card classifications run, for checking how much tracking saves
+        self.classified = 0
+
+    def frame_is_still(self, frame):
+        """True if frame looks the same as the last frame that was processed."""
+        small = cv2.cvtColor(shrink(frame, STILL_FRAME_DIM), cv2.COLOR_BGR2GRAY)
+        still = (
+            self.last_still is not None
+            and self.last_still.shape == small.shape
+            and mean_abs_diff(self.last_still, small) < STILL_FRAME_DIFF
+        )
+        if not still:
+            self.last_still = small
+        return still
+
+    def match(self, corners):
+        """The unmatched track closest to a detection, if close enough."""
+        center = corners.mean(axis=0)
+        best, best_dist = None, None
+        for track in self.tracks:
+            if track.misses == 0:
+                # already matched this frame
+                continue
+            dist = float(np.linalg.norm(track.center - center))
+            if dist < MAX_MATCH_DIST * track.diagonal and (
+                best is None or dist < best_dist
+            ):
+                best, best_dist = track, dist
+        return best
+
+    def update_tracks(self, frame):
+        for track in self.tracks:
+            track.misses += 1
+
+        for card_im, corners in find_cards(frame, with_corners=True):
+            track = self.match(corners)
+            thumb = thumbnail(card_im)
+            if track is None:
+                track = Track(self.next_id, card_im, corners)
+                self.next_id += 1
+                self.tracks.append(track)
+            elif mean_abs_diff(track.thumb, thumb) > CARD_CHANGE_DIFF:
+                # same place, different card (or a big lighting change)
+                track.card = Card(card_im, corners)
+                track.thumb = thumb
+            else:
+                # the card only moved, keep its label
+                track.card.corners = corners
+            track.misses = 0
+
+            if track.card.label is None:
+                instrument.count("stream_cards_classified")
+                self.classified += 1
+                track.card.label = self.classify(card_im)
+
+        self.tracks = [t for t in self.tracks if t.misses <= MAX_MISSES]
+
+    def process(self, frame):
+        self.frame_num += 1
+        if self.frame_is_still(frame):
+            instrument.count("stream_frames_skipped")
+            return
+
+        with instrument.span("StreamSolver.update_tracks"):
+            self.update_tracks(frame)
+
+        visible = [t for t in self.tracks if t.misses == 0]
+        board = sorted((t.id, t.card.label) for t in visible)
+        if board == self.board:
+            return
+        self.board = board
+
+        game = SetGame(frame)
+        game.cards = [t.card for t in visible]
+        game.find_sets()
+        self.game = game
+        return {
+            "frame": self.frame_num,
+            "cards": [
+                {"id": t.id, "label": t.card.label, "corners": t.card.corners.tolist()}
+                for t in visible
+            ],
+            "sets": [[game.cards.index(card) for card in s] for s in game.sets],
+        }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Solve SET from a video file, camera or image sequence."
+    )
+    parser.add_argument(
+        "source",
+        metavar="source",
+        type=str,
+        help="Video file, camera index, image directory, glob or printf pattern",
+    )
+    parser.add_argument(
+        "--display",
+        dest="display",
+        action="store_true",
+        help="Display each frame with the current sets drawn on it",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+
+    solver = StreamSolver()
+    for frame in iter_frames(args.source):
+        update = solver.process(frame)
+        if update:
+            print(json.dumps(update))
+            sys.stdout.flush()
+
+        if args.display and solver.board is not None:
+            solver.game.im = frame
+            solver.game.draw_sets()
+            cv2.imshow("sets", shrink(frame))
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+
+    if args.display:
+        cv2.destroyAllWindows()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""Generate synthetic SET game images from the labeled card crops, with
+ground truth labels and corners, for load and scaling tests (and as a start
+on a fake training set).
+
+Each board is written as soon as it is made, as NNNNNN.jpg plus NNNNNN.json
+with the card labels, their corners in the image (clockwise from the top
+left of the card's upright image) and the sets on the board. Every board
+also gets a line in index.jsonl. Board i is generated from seed (seed, i),
+so any single board can be regenerated without making the ones before it.
+
+usage: ./synth_games.py synth-out --count 10000 --cards 12-21
+"""
+
+import argparse
+import json
+import os
+import sys
+import cv2
+import numpy as np
+from common import ALL_CARDS_LABELED_DIR, jpgs_in_dir
+from SetGame import ENCODING
+
+DEFAULT_SIZE = (2000, 1500)
+# fraction of each grid cell left as space around the card
+CELL_MARGIN = 0.15
+# background gray level range, dark enough for the card threshold
+BACKGROUND_LEVELS = (30, 110)
+JPEG_QUALITY = 90
+
+
+class SynthOptions(object):
+    """How boards are generated. Angles are in degrees, perspective is the
+  largest corner offset as a fraction of the card's width, lighting the
+  largest brightness change across the board as a fraction, and noise the
+  standard deviation of the added gaussian noise in gray levels.
+  """
+
+    def __init__(
+        self,
+        min_cards=12,
+        max_cards=12,
+        size=DEFAULT_SIZE,
+        rotation=8.0,
+        perspective=0.04,
+        lighting=0.25,
+        noise=4.0,
+    ):
+        if not 1 <= min_cards <= max_cards <= 81:
+            raise ValueError("Card counts must be within 1-81")
+        self.min_cards = min_cards
+        self.max_cards = max_cards
+        self.size = size
+        self.rotation = rotation
+        self.perspective = perspective
+        self.lighting = lighting
+        self.noise = noise
+
+
+def load_cards(cards_dir=ALL_CARDS_LABELED_DIR):
+    """(label, image) for each labeled card, sorted by label."""
+    return [
+        (label, cv2.imread(os.path.join(cards_dir, label)))
+        for label in sorted(jpgs_in_dir(cards_dir))
+    ]
+
+
+def grid_shape(n, size, card_size):
+    """(cols, rows) of the grid of n cells that fits the biggest cards."""
+    w, h = size
+    card_w, card_h = card_size
+    best, best_scale = (n, 1), 0
+    for cols in range(1, n + 1):
+        rows = -(-n // cols)
+        scale = min(w / float(cols * card_w), h / float(rows * card_h))
+        if scale > best_scale:
+            best, best_scale = (cols, rows), scale
+    return best
+
+
+def card_corners(rng, center, card_size, options):
+    """Corners of a card placed at center: rotated, then each corner moved by
+  up to the perspective jitter.
+  """
+    w, h = card_size
+    corners = np.array(
+        [[-w / 2, -h / 2], [w / 2, -h / 2], [w / 2, h / 2], [-w / 2, h / 2]]
+    )
+    angle = np.radians(rng.uniform(-options.rotation, options.rotation))
+    rotation = np.array(
+        [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    )
+    corners = corners.dot(rotation.T)
+    jitter = options.perspective * w
+    corners += rng.uniform(-jitter, jitter, (4, 2))
+    return (corners + center).astype(np.float32)
+
+
+def paste_card(board, card_im, corners):
+    """Warp card_im onto board at corners, only touching the pixels inside
+  the card's bounding box.
+  """
+    x, y, w, h = cv2.boundingRect(corners)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, board.shape[1]), min(y + h, board.shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    card_h, card_w = card_im.shape[:2]
+    src = np.array(
+        [[0, 0], [card_w - 1, 0], [card_w - 1, card_h - 1], [0, card_h - 1]],
+        np.float32,
+    )
+    offset = np.array([x0, y0], np.float32)
+    transform = cv2.getPerspectiveTransform(src, corners - offset)
+    roi = board[y0:y1, x0:x1]
+    warp = cv2.warpPerspective(card_im, transform, (x1 - x0, y1 - y0))
+    mask = cv2.warpPerspective(
+        np.full((card_h, card_w), 255, np.uint8), transform, (x1 - x0, y1 - y0)
+    )
+    roi[mask > 0] = warp[mask > 0]
+
+
+def apply_lighting(rng, board, lighting):
+    """Brightness gradient in a random direction, and a slight color cast."""
+    h, w = board.shape[:2]
+    angle = rng.uniform(0, 2 * np.pi)
+    xs = np.linspace(-0.5, 0.5, w, dtype=np.float32)
+    ys = np.linspace(-0.5, 0.5, h, dtype=np.float32)
+    gradient = np.cos(angle) * xs[None, :] + np.sin(angle) * ys[:, None]
+    gain = 1 + lighting * (gradient + rng.uniform(-0.5, 0.5))
+    cast = 1 + rng.uniform(-lighting, lighting, 3) / 4
+    lit = board.astype(np.float32) * gain[:, :, None] * cast.astype(np.float32)
+    return lit
+
+
+def make_board(cards, rng, options):
+    """Make one board. Returns the image and its ground truth dict."""
+    n = int(rng.integers(options.min_cards, options.max_cards + 1))
+    chosen = sorted(rng.choice(len(cards), n, replace=False))
+    w, h = options.size
+    card_h, card_w = cards[0][1].shape[:2]
+
+    cols, rows = grid_shape(n, options.size, (card_w, card_h))
+    cell_w, cell_h = w / float(cols), h / float(rows)
+    # size of the card's bounding box at the largest rotation and jitter, so
+    # neighbouring cards never touch
+    angle = np.radians(options.rotation)
+    jitter = 2 * options.perspective * card_w
+    box_w = card_w * np.cos(angle) + card_h * np.sin(angle) + jitter
+    box_h = card_h * np.cos(angle) + card_w * np.sin(angle) + jitter
+    scale = (1 - CELL_MARGIN) * min(cell_w / box_w, cell_h / box_h)
+    # cards fill random cells, so partly full grids don't always leave the
+    # same cells empty
+    cells = rng.permutation(cols * rows)[:n]
+
+    board = np.empty((h, w, 3), np.uint8)
+    board[:] = rng.integers(*BACKGROUND_LEVELS, size=3)
+    labels, corners_list = [], []
+    for i, cell in zip(chosen, cells):
+        label, card_im = cards[i]
+        center = ((cell % cols + 0.5) * cell_w, (cell // cols + 0.5) * cell_h)
+        corners = card_corners(rng, center, (card_w * scale, card_h * scale), options)
+        paste_card(board, card_im, corners)
+        labels.append(label)
+        corners_list.append(corners.round(2).tolist())
+
+    im = apply_lighting(rng, board, options.lighting)
+    if options.noise:
+        im += rng.normal(0, options.noise, im.shape).astype(np.float32)
+    im = np.clip(im, 0, 255).astype(np.uint8)
+
+    codes = [ENCODING.encode(label) for label in labels]
+    truth = {
+        "labels": labels,
+        "corners": corners_list,
+        "sets": [list(s) for s in ENCODING.find_sets(codes)],
+        "size": [w, h],
+    }
+    return im, truth
+
+
+def generate_boards(count, options=None, seed=0, start=0, cards=None):
+    """Yield (index, image, truth) for boards start to start+count-1, one at
+  a time, so any number of boards can be generated in constant memory.
+  """
+    options = options or SynthOptions()
+    cards = cards or load_cards()
+    for i in range(start, start + count):
+        rng = np.random.default_rng([seed, i])
+        im, truth = make_board(cards, rng, options)
+        truth["seed"] = [seed, i]
+        yield i, im, truth
+
+
+def write_boards(boards, out_dir, quiet=False):
+    """Write each board as it comes, returning how many were written."""
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    written = 0
+    with open(os.path.join(out_dir, "index.jsonl"), "a") as index:
+        for i, im, truth in boards:
+            name = "{:06d}".format(i)
+            cv2.imwrite(
+                os.path.join(out_dir, name + ".jpg"),
+                im,
+                [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY],
+            )
+            with open(os.path.join(out_dir, name + ".json"), "w") as f:
+                json.dump(truth, f)
+            truth["image"] = name + ".jpg"
+            index.write(json.dumps(truth) + "\n")
+            index.flush()
+            written += 1
+            if not quiet:
+                print(os.path.join(out_dir, name + ".jpg"))
+    return written
+
+
+def parse_range(s):
+    """'12' -> (12, 12), '12-21' -> (12, 21)"""
+    parts = s.split("-")
+    return int(parts[0]), int(parts[-1])
+
+
+def parse_size(s):
+    """'2000x1500' -> (2000, 1500)"""
+    w, h = s.lower().split("x")
+    return int(w), int(h)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic SET game images with ground truth."
+    )
+    parser.add_argument("out_dir", metavar="out_dir", type=str)
+    parser.add_argument(
+        "--count", dest="count", type=int, default=10, help="Boards to generate"
+    )
+    parser.add_argument(
+        "--start", dest="start", type=int, default=0, help="Index of the first board"
+    )
+    parser.add_argument(
+        "--cards",
+        dest="cards",
+        type=parse_range,
+        default=(12, 12),
+        help="Cards per board, like 12 or 12-21, at most 81 (default 12)",
+    )
+    parser.add_argument(
+        "--size",
+        dest="size",
+        type=parse_size,
+        default=DEFAULT_SIZE,
+        help="Image size as WxH (default {}x{})".format(*DEFAULT_SIZE),
+    )
+    parser.add_argument(
+        "--rotation",
+        dest="rotation",
+        type=float,
+        default=8.0,
+        help="Largest card rotation in degrees (default %(default)s)",
+    )
+    parser.add_argument(
+        "--perspective",
+        dest="perspective",
+        type=float,
+        default=0.04,
+        help="Largest corner jitter, as a fraction of card width (default %(default)s)",
+    )
+    parser.add_argument(
+        "--lighting",
+        dest="lighting",
+        type=float,
+        default=0.25,
+        help="Largest brightness change across the board (default %(default)s)",
+    )
+    parser.add_argument(
+        "--noise",
+        dest="noise",
+        type=float,
+        default=4.0,
+        help="Standard deviation of gaussian noise (default %(default)s)",
+    )
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    parser.add_argument(
+        "--quiet", dest="quiet", action="store_true", help="Don't print filenames"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    try:
+        options = SynthOptions(
+            args.cards[0],
+            args.cards[1],
+            args.size,
+            args.rotation,
+            args.perspective,
+            args.lighting,
+            args.noise,
+        )
+    except ValueError as e:
+        print("Error: {}".format(e))
+        sys.exit(1)
+
+    boards = generate_boards(args.count, options, seed=args.seed, start=args.start)
+    write_boards(boards, args.out_dir, quiet=args.quiet)
+
+
+if __name__ == "__main__":
+    main()